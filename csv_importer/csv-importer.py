@@ -2,6 +2,7 @@
 import typer
 import sqlite3
 import csv
+import time
 from numbers import Number
 
 from pprint import pprint
@@ -74,8 +75,8 @@ def _db_transaction_factory(db_path):
             c.close()
     return _db_transaction
 
-def _csv_import_profile(db_path, ebay_profiles_entries, new_profile_dict):
-    # Process new_profile_dict into the correct types
+# Processes new_profile_dict into the correct types
+def _convert_profile(new_profile_dict):
     new_profile_dict['profile_id'] = _appl(int, new_profile_dict, 'profile_id')
     new_profile_dict['description'] = _appl(str, new_profile_dict, 'description')
     new_profile_dict['contacted'] = _appl(str, new_profile_dict, 'contacted')
@@ -89,6 +90,10 @@ def _csv_import_profile(db_path, ebay_profiles_entries, new_profile_dict):
     new_profile_dict['n_followers'] = _appl(str, new_profile_dict, 'n_followers')
     new_profile_dict['n_reviews'] = _appl(str, new_profile_dict, 'n_reviews')
     new_profile_dict['percent_positive_feedback'] = _appl(str, new_profile_dict, 'percent_positive_feedback')
+    return new_profile_dict
+
+def _csv_import_profile(db_path, ebay_profiles_entries, new_profile_dict):
+    _convert_profile(new_profile_dict)
 
     existing_profile_dict = {}
     for e in ebay_profiles_entries:
@@ -141,8 +146,98 @@ def _csv_import_profile(db_path, ebay_profiles_entries, new_profile_dict):
                 a['member_since'], a['member_since_unix'], a['n_followers'],
                 a['n_reviews'], a['percent_positive_feedback']))
 
+# Merges the rows of one chunk into table, through the staging table.  As in
+# _merge_dicts, each non-null value replaces the existing one.  Rows left
+# without a value for a NOT NULL column are rejected.  Returns the number of
+# rows written.
+def _bulk_merge_chunk(c, table, key, columns, not_null, rows):
+    c.execute('DELETE FROM temp.staging')
+    c.executemany('INSERT INTO temp.staging ({}) VALUES ({})'.format( \
+            ', '.join(columns), ', '.join('?' * len(columns))), \
+            (tuple(r[k] for k in columns) for r in rows))
+
+    merged = ['s.{0}'.format(key)] + ['COALESCE(s.{0}, e.{0})'.format(k) \
+            for k in columns if k != key]
+    checks = ['COALESCE(s.{0}, e.{0}) IS NOT NULL'.format(k) for k in not_null]
+    # The merged values are final, so a conflicting row is simply replaced
+    return c.execute('''
+        INSERT INTO {0} ({1})
+        SELECT {2} FROM temp.staging AS s
+        LEFT JOIN {0} AS e ON e.{3} = s.{3}
+        WHERE {4}
+        ON CONFLICT ({3}) DO UPDATE SET {5}
+    '''.format(table, ', '.join(columns), ', '.join(merged), key, \
+            ' AND '.join(checks), \
+            ', '.join('{0} = excluded.{0}'.format(k) for k in columns \
+                if k != key))).rowcount
+
+# Streams the CSV at path into table in chunks of chunk_size rows, merging each
+# chunk with set-based SQL in its own transaction
+#
+# If given, images(d) returns the auction_images rows of each converted row d,
+# which are appended in the same transaction as its chunk.
+def _bulk_import(db_path, table, key, convert, path, chunk_size, images=None):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        c = conn.cursor()
+        info = c.execute("pragma table_info('{}')".format(table)).fetchall()
+        columns = [row[1] for row in info]
+        not_null = [row[1] for row in info if row[3] or row[1] == key]
+        # The staging table takes the columns' affinities, but no constraints
+        c.execute('CREATE TEMP TABLE staging AS SELECT * FROM main.{} LIMIT 0' \
+                .format(table))
+
+        n_read = 0
+        n_written = 0
+        n_rejected = 0
+        start = time.monotonic()
+        with open(path) as fd:
+            reader = csv.DictReader(fd)
+            while True:
+                # Rows repeating a key within the chunk are merged into the
+                # first, as a row-by-row import would merge them in turn
+                chunk = {}
+                chunk_images = []
+                n_chunk = 0
+                for d in reader:
+                    n_chunk += 1
+                    d = convert(d)
+                    if images is not None:
+                        chunk_images.extend(images(d))
+                    try:
+                        row = chunk[d[key]]
+                    except KeyError:
+                        row = chunk[d[key]] = dict.fromkeys(columns)
+                    row.update((k, d[k]) for k in columns if d[k] is not None)
+                    if n_chunk == chunk_size:
+                        break
+                if n_chunk == 0:
+                    break
+                n_read += n_chunk
+
+                c.execute('BEGIN TRANSACTION')
+                try:
+                    n = _bulk_merge_chunk(c, table, key, columns, not_null, \
+                            chunk.values())
+                    c.executemany(_APPEND_IMAGE_SQL, chunk_images)
+                    c.execute('COMMIT')
+                except:
+                    c.execute('ROLLBACK')
+                    raise
+                n_written += n
+                n_rejected += len(chunk) - n
+
+                elapsed = time.monotonic() - start
+                print('{} rows read, {} written, {:.0f} rows/s'.format(n_read, \
+                        n_written, n_read / elapsed if elapsed else 0))
+    finally:
+        conn.close()
+
+    print('Imported {} rows into {}: {} written, {} rejected for missing ' \
+            'values'.format(n_read, table, n_written, n_rejected))
+
 @app.command()
-def profile(db_path, path):
+def profile(db_path, path, bulk: bool = False, chunk_size: int = 50000):
     # Initialise dbs
     @_db_transaction_factory(db_path)
     def _(c):
@@ -169,14 +264,19 @@ def profile(db_path, path):
         return [row[1] for row in \
             c.execute("pragma table_info('ebay_profiles')").fetchall()]
 
+    if bulk:
+        _bulk_import(db_path, 'ebay_profiles', 'profile_id', _convert_profile, \
+                path, chunk_size)
+        return
+
     # Read CSV into new_auction_dict
     with open(path) as fd:
         reader = csv.DictReader(fd)
         for d in reader:
             _csv_import_profile(db_path, ebay_profiles_entries, d)
 
-def _csv_import_auction(db_path, ebay_auctions_entries, new_auction_dict):
-    # Process new_auction_dict into the correct types
+# Processes new_auction_dict into the correct types
+def _convert_auction(new_auction_dict):
     new_auction_dict['auction_id'] = _appl(int, new_auction_dict, 'auction_id')
     new_auction_dict['title'] = _appl(str, new_auction_dict, 'title')
     new_auction_dict['seller'] = _appl(str, new_auction_dict, 'seller')
@@ -191,6 +291,31 @@ def _csv_import_auction(db_path, ebay_auctions_entries, new_auction_dict):
     new_auction_dict['location_id'] = _appl(str, new_auction_dict, 'location_id')
     new_auction_dict['image_paths'] = _appl(str, new_auction_dict, 'image_paths')
     new_auction_dict['description'] = _appl(str, new_auction_dict, 'description')
+    return new_auction_dict
+
+# Appends an image to those of its auction, as ebay-scraper does
+_APPEND_IMAGE_SQL = '''
+    INSERT INTO auction_images (auction_id, position, url, path, size, hash)
+    VALUES (:auction_id, (SELECT COALESCE(MAX(position) + 1, 0)
+        FROM auction_images WHERE auction_id = :auction_id),
+        :url, :path, :size, :hash)
+    ON CONFLICT (auction_id, path) DO UPDATE SET
+        url = COALESCE(excluded.url, url),
+        size = COALESCE(excluded.size, size),
+        hash = COALESCE(excluded.hash, hash)
+'''
+
+# Returns the auction_images rows of the colon-separated image_paths of an
+# auction processed by _convert_auction
+def _image_rows(a):
+    if a['auction_id'] is None or a['image_paths'] is None:
+        return []
+    return [{'auction_id': a['auction_id'], 'url': None, 'path': p, \
+            'size': None, 'hash': None} for p in a['image_paths'].split(':') \
+            if p]
+
+def _csv_import_auction(db_path, ebay_auctions_entries, new_auction_dict):
+    _convert_auction(new_auction_dict)
 
     existing_auction_dict = {}
     for e in ebay_auctions_entries:
@@ -235,16 +360,19 @@ def _csv_import_auction(db_path, ebay_auctions_entries, new_auction_dict):
         c.execute('''INSERT INTO ebay_auctions (
             auction_id, title, seller, start_time, end_time, n_bids,
             price, currency_code, starting_price, buy_now_price,
-            winner, location_id, image_paths, description) VALUES (
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+            winner, location_id, description) VALUES (
+            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
             )''',
             (auction_id, a['title'], a['seller'], a['start_time'], \
                 a['end_time'], a['n_bids'], a['price'], a['currency_code'], \
                 a['starting_price'], a['buy_now_price'], a['winner'], \
-                a['location_id'], a['image_paths'], a['description']))
+                a['location_id'], a['description']))
+
+        # Add its images
+        c.executemany(_APPEND_IMAGE_SQL, _image_rows(a))
 
 @app.command()
-def auction(db_path, path):
+def auction(db_path, path, bulk: bool = False, chunk_size: int = 50000):
     # Initialise dbs
     @_db_transaction_factory(db_path)
     def _(c):
@@ -262,16 +390,45 @@ def auction(db_path, path):
                 starting_price INTEGER,
                 winner TEXT,
                 location_id TEXT,  -- Primary key of locations table
-                image_paths TEXT NOT NULL, -- colon-separated paths relative to some base path
                 description TEXT
             )
         ''')
 
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS auction_images (
+                auction_id INTEGER NOT NULL,   -- Primary key of auctions table
+                position INTEGER NOT NULL,  -- Order of the image in its auction
+                url TEXT,
+                path TEXT NOT NULL,
+                size INTEGER,   -- In bytes
+                hash TEXT,  -- Hex SHA-256 of the image
+                PRIMARY KEY (auction_id, position)
+            )
+        ''')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' \
+                'auction_images_auction_path ON auction_images (auction_id, path)')
+        c.execute('CREATE INDEX IF NOT EXISTS auction_images_path ' \
+                'ON auction_images (path)')
+        c.execute('CREATE INDEX IF NOT EXISTS auction_images_hash ' \
+                'ON auction_images (hash)')
+
     @_db_transaction_factory(db_path)
     def ebay_auctions_entries(c):
         return [row[1] for row in \
             c.execute("pragma table_info('ebay_auctions')").fetchall()]
 
+    # Images are kept in the auction_images table since ebay-scraper's schema
+    # version 1, which only ebay-scraper migrates to
+    if 'image_paths' in ebay_auctions_entries:
+        print(f'{db_path} has the image_paths column of an older ' \
+                'ebay-scraper.  Open it with ebay-scraper to migrate it first.')
+        raise typer.Exit(1)
+
+    if bulk:
+        _bulk_import(db_path, 'ebay_auctions', 'auction_id', _convert_auction, \
+                path, chunk_size, images=_image_rows)
+        return
+
     # Read CSV into new_auction_dict
     with open(path) as fd:
         reader = csv.DictReader(fd)
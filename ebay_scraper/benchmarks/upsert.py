@@ -0,0 +1,78 @@
+# Compares the rows per second merged into ebay_auctions and ebay_profiles by
+# the original read-merge-write cycle and by the single-statement upserts.
+#
+# Run with: python benchmarks/upsert.py [N_ROWS]
+import pathlib
+import random
+import sys
+import tempfile
+import time
+
+from ebay_scraper import db_interface
+
+def _auction(i, rng):
+    return {
+        'auction_id': i,
+        'title': 'Mambila mask {}'.format(i),
+        'seller': 'seller{}'.format(i % 100),
+        'start_time': 1600000000 + i,
+        'end_time': 1600100000 + rng.randint(0, 1000),
+        'n_bids': rng.randint(0, 20),
+        'price': rng.choice([None, rng.randint(1, 500)]),
+        'currency_code': 'USD',
+        'description': 'A fine carved mask. ' * 20
+    }
+
+def _profile(i, rng):
+    return {
+        'profile_id': 'seller{}'.format(i),
+        'description': 'Collector of West African art',
+        'location': 'United Kingdom',
+        'member_since': 'Jun 03, 2009',
+        'member_since_unix': 1243987200,
+        'n_followers': None,
+        'n_reviews': None,
+        'percent_positive_feedback': rng.randint(90, 100)
+    }
+
+# Returns the rows per second of merging rows, in transactions of 500, first
+# into an empty table and then over the rows just written
+def _rate(e, write, rows):
+    start = time.perf_counter()
+    for _ in range(2):
+        for i in range(0, len(rows), 500):
+            batch = rows[i:i+500]
+            def _(c):
+                for row in batch:
+                    write(c, dict(row))
+            e._db_transaction(_)
+    return 2 * len(rows) / (time.perf_counter() - start)
+
+def main(n_rows=20000):
+    rng = random.Random(0)
+    auctions = [_auction(i, rng) for i in range(n_rows)]
+    profiles = [_profile(i, rng) for i in range(n_rows)]
+
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        for name, rows, reference, upsert_sql, entries in [ \
+                ('auctions', auctions, \
+                    db_interface._merge_and_write_auction_reference, \
+                    db_interface._auction_upsert_sql, 'ebay_auctions_entries'), \
+                ('profiles', profiles, \
+                    db_interface._merge_and_write_profile_reference, \
+                    db_interface._profile_upsert_sql, 'ebay_profiles_entries')]:
+            before = db_interface.EbayScraper(d.joinpath(name + '_before.db'), d)
+            after = db_interface.EbayScraper(d.joinpath(name + '_after.db'), d)
+            rate_before = _rate(before, lambda c, r: \
+                    reference(c, r, getattr(before, entries)), rows)
+            rate_after = _rate(after, lambda c, r: \
+                    after._upsert(c, upsert_sql(r), r), rows)
+            before.close()
+            after.close()
+            print('{}: {:.0f} rows/s before, {:.0f} rows/s after ({:.1f}x)' \
+                    .format(name, rate_before, rate_after, \
+                    rate_after / rate_before))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,185 @@
+import gzip
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ['gzip', 'zstd']
+
+# An append-only archive of fetched pages.  The raw bytes of each page are
+# compressed and appended to the current pack file in location, which is
+# replaced by a new one once it exceeds max_pack_size bytes.  An index in
+# location/index.db maps each page's kind, ID and fetch time to its bytes.
+#
+# Pages are content addressed: bytes already in the archive, such as a page
+# fetched again unchanged, are recorded against the copy stored before rather
+# than being appended again.  Reading a page back is one index lookup and one
+# read from its pack file.
+class PageArchive():
+    def __init__(self, location, compression: str = 'gzip', \
+            max_pack_size: int = 1024**3):
+        if compression not in COMPRESSIONS:
+            raise ValueError('compression must be one of {}' \
+                    .format(COMPRESSIONS))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires zstandard to be ' \
+                    'installed')
+        self.location = pathlib.Path(location)
+        self.location.mkdir(parents=True, exist_ok=True)
+        self.compression = compression
+        self.max_pack_size = max_pack_size
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.location.joinpath('index.db'), \
+                timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT NOT NULL PRIMARY KEY,  -- Hex SHA-256 of the page
+                    pack INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,   -- Compressed, in bytes
+                    size INTEGER NOT NULL,  -- Uncompressed, in bytes
+                    compression TEXT NOT NULL
+                )
+            ''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    kind TEXT NOT NULL,   -- 'auction', 'profile' or 'iframe'
+                    page_id TEXT NOT NULL,
+                    fetched REAL NOT NULL,  -- Unix time
+                    url TEXT,
+                    encoding TEXT,
+                    hash TEXT NOT NULL,  -- Primary key of blobs table
+                    PRIMARY KEY (kind, page_id, fetched)
+                )
+            ''')
+
+        # Appends go to the last pack
+        r = self._conn.execute('SELECT MAX(pack) FROM blobs').fetchone()
+        self._pack = r[0] if r[0] is not None else 0
+        self._pack_file = None
+
+    def _pack_path(self, pack):
+        return self.location.joinpath('pages-{:06d}.pack'.format(pack))
+
+    def _compress(self, data):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        # Level 6 compresses almost as well as the default 9, in a quarter of
+        # the time
+        return gzip.compress(data, compresslevel=6)
+
+    @staticmethod
+    def _decompress(data, compression):
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('Reading zstd pages requires zstandard to ' \
+                        'be installed')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    # Stores data, the raw bytes of the page of the given kind and ID, as
+    # fetched from url at fetched (now if not given).  Returns its hash.
+    def put(self, kind: str, page_id, data: bytes, url: str = None, \
+            encoding: str = None, fetched: float = None):
+        if fetched is None:
+            fetched = time.time()
+        h = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            exists = self._conn.execute('SELECT 1 FROM blobs WHERE hash = ?', \
+                    (h,)).fetchone() is not None
+            with self._conn:
+                if not exists:
+                    self._append(h, data)
+                self._conn.execute('INSERT OR REPLACE INTO pages (kind, ' \
+                        'page_id, fetched, url, encoding, hash) ' \
+                        'VALUES (?, ?, ?, ?, ?, ?)', (kind, str(page_id), \
+                        fetched, url, encoding, h))
+        return h
+
+    # Appends the compressed data to the current pack, and indexes it
+    def _append(self, h, data):
+        compressed = self._compress(data)
+        if self._pack_file is None:
+            self._pack_file = open(self._pack_path(self._pack), 'ab')
+        offset = self._pack_file.seek(0, 2)
+        if offset and offset + len(compressed) > self.max_pack_size:
+            self._pack_file.close()
+            self._pack += 1
+            self._pack_file = open(self._pack_path(self._pack), 'ab')
+            offset = self._pack_file.seek(0, 2)
+        self._pack_file.write(compressed)
+        self._pack_file.flush()
+        self._conn.execute('INSERT INTO blobs (hash, pack, offset, length, ' \
+                'size, compression) VALUES (?, ?, ?, ?, ?, ?)', (h, \
+                self._pack, offset, len(compressed), len(data), \
+                self.compression))
+
+    # Returns the record of the page of the given kind and ID fetched at
+    # fetched, or last fetched if not given, or None if it is not stored
+    def lookup(self, kind: str, page_id, fetched: float = None):
+        sql = 'SELECT kind, page_id, fetched, url, encoding, hash FROM pages ' \
+                'WHERE kind = ? AND page_id = ?'
+        params = [kind, str(page_id)]
+        if fetched is not None:
+            sql += ' AND fetched = ?'
+            params.append(fetched)
+        sql += ' ORDER BY fetched DESC LIMIT 1'
+        with self._lock:
+            r = self._conn.execute(sql, params).fetchone()
+        if r is None:
+            return None
+        return dict(zip(['kind', 'page_id', 'fetched', 'url', 'encoding', \
+                'hash'], r))
+
+    # Returns the bytes stored under hash h
+    def read(self, h):
+        with self._lock:
+            r = self._conn.execute('SELECT pack, offset, length, compression ' \
+                    'FROM blobs WHERE hash = ?', (h,)).fetchone()
+        if r is None:
+            raise KeyError(h)
+        pack, offset, length, compression = r
+        with open(self._pack_path(pack), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return self._decompress(data, compression)
+
+    # Returns the bytes of the page of the given kind and ID, as for lookup,
+    # or None if it is not stored
+    def get(self, kind: str, page_id, fetched: float = None):
+        record = self.lookup(kind, page_id, fetched)
+        if record is None:
+            return None
+        return self.read(record['hash'])
+
+    # Returns the records of every page stored, optionally of one kind only,
+    # oldest first
+    def pages(self, kind: str = None):
+        sql = 'SELECT kind, page_id, fetched, url, encoding, hash FROM pages'
+        params = []
+        if kind is not None:
+            sql += ' WHERE kind = ?'
+            params.append(kind)
+        sql += ' ORDER BY fetched'
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(zip(['kind', 'page_id', 'fetched', 'url', 'encoding', \
+                'hash'], r)) for r in rows]
+
+    def close(self):
+        with self._lock:
+            if self._pack_file is not None:
+                self._pack_file.close()
+                self._pack_file = None
+            self._conn.close()
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# An on-disk cache of HTTP responses, keyed by URL.  Each entry is stored as a
+# body file and a metadata file in location.  Entries younger than ttl seconds
+# are served without touching the network; older entries are revalidated with
+# a conditional request, using their ETag and Last-Modified headers.  Once the
+# bodies exceed max_size bytes, the least recently used entries are evicted.
+class ResponseCache():
+    def __init__(self, location, ttl: float = 3600, max_size: int = 1024**3):
+        self.location = pathlib.Path(location)
+        self.location.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.bytes_saved = 0
+
+        self._lock = threading.Lock()
+        # Maps each key to its body size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._load()
+
+    def _paths(self, key):
+        d = self.location.joinpath(key[:2])
+        return d.joinpath(key + '.body'), d.joinpath(key + '.json')
+
+    # Rebuilds the index from disk.  A body's mtime is its last access time.
+    def _load(self):
+        entries = []
+        for body_path in self.location.glob('*/*.body'):
+            try:
+                stat = body_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, body_path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    # Returns (metadata, body) for url, or None if it is not cached
+    def lookup(self, url):
+        key = self._key(url)
+        with self._lock:
+            if key not in self._entries:
+                return None
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            self._remove(key)
+            return None
+        return meta, body
+
+    def is_fresh(self, meta):
+        return time.time() - meta['fetched'] < self.ttl
+
+    # Adds the conditional request headers for a cached entry
+    @staticmethod
+    def conditional_headers(meta):
+        headers = {}
+        if meta.get('etag') is not None:
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified') is not None:
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, r):
+        key = self._key(url)
+        body = r.content
+        meta = {
+            'url': url,
+            'fetched': time.time(),
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'encoding': r.encoding,
+            'headers': dict(r.headers)
+        }
+
+        body_path, meta_path = self._paths(key)
+        body_path.parent.mkdir(exist_ok=True)
+        self._write_atomic(body_path, body, 'wb')
+        self._write_atomic(meta_path, json.dumps(meta), 'w')
+
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = len(body)
+            self._size += len(body)
+        self._evict()
+
+    # Marks a cached entry as used, and optionally as fetched again now
+    def touch(self, url, meta, revalidated: bool = False):
+        key = self._key(url)
+        body_path, meta_path = self._paths(key)
+        if revalidated:
+            meta['fetched'] = time.time()
+            self._write_atomic(meta_path, json.dumps(meta), 'w')
+        try:
+            os.utime(body_path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def record(self, hit: bool = False, revalidated: bool = False, size: int = 0):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+            if revalidated:
+                self.revalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, \
+                    'revalidations': self.revalidations, \
+                    'bytes_saved': self.bytes_saved, \
+                    'entries': len(self._entries), 'size': self._size}
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.max_size or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._size -= size
+            for path in self._paths(key):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def _remove(self, key):
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _write_atomic(path, data, mode):
+        tmp_path = path.with_name('.{}.{}.part'.format(path.name, uuid.uuid4().hex))
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    # Builds a response to url from a cached entry
+    @staticmethod
+    def response(url, meta, body):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r._content = body
+        r.encoding = meta['encoding']
+        r.headers = CaseInsensitiveDict(meta['headers'])
+        return r
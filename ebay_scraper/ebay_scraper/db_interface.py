@@ -1,15 +1,32 @@
+import os
 import pathlib
-import requests
 from termcolor import colored
 from urllib.parse import urlparse
 import sqlite3
 import pickle
+import threading
+import queue
+import time
+import atexit
+import uuid
+import hashlib
 import traceback
+import multiprocessing
+import heapq
+import json
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, \
+        wait, FIRST_COMPLETED
 from numbers import Number
 
 from pprint import pprint
 
 from . import scraper
+from . import phash
+from .transport import Transport
+from .archive import PageArchive
+
+# Bytes read from the network per write when streaming images to disk
+_IMAGE_CHUNK_SIZE = 64 * 1024
 
 # From https://stackoverflow.com/questions/18092354/python-split-string-without-splitting-escaped-character#21107911
 def _escape_split(s, delim):
@@ -61,177 +78,1063 @@ def _merge_dicts(d1: dict, d2: dict):
                 .format(v1, type(v1), v2, type(v2)))
     return d1
 
+# The original read-merge-write cycles, which _auction_upsert_sql and
+# _profile_upsert_sql reproduce in one statement.  Kept as the reference they
+# are tested and benchmarked against.  entries are the table's column names.
+def _merge_and_write_auction_reference(c, auction: dict, entries):
+    # Determine if an auction of the given id currently exists
+    c.execute('SELECT * FROM ebay_auctions WHERE auction_id=?',\
+            (auction['auction_id'],))
+    r = c.fetchall()
+    existing_entry = r[0] if r else None
+
+    existing_auction = {}
+    if existing_entry is not None:
+        # Merge existing entries
+        for name, e in zip(entries, existing_entry):
+            existing_auction[name] = e
+
+    # Determine whether auction or existing_auction is newer
+    current_newer = False
+    if existing_entry is not None:
+        # Determine which entry is newer
+        try:
+            current_newer = auction['n_bids'] > existing_auction['n_bids'] \
+                    or auction['end_time'] > existing_auction['end_time'] \
+                    or (auction['currency_code'] == \
+                        existing_auction['currency_code'] \
+                    and auction['price'] > existing_auction['price'])
+        except TypeError:
+            # Short-circuiting of previous expressions will fail if evaluates
+            # in place of None
+            pass
+        except KeyError:
+            # existing auction must have failed, so the current is newer
+            current_newer = True
+    
+    if current_newer:
+        a = _merge_dicts(existing_auction, auction)
+    else:
+        a = _merge_dicts(auction, existing_auction)
+
+    # Delete the row
+    if existing_entry is not None:
+        c.execute('DELETE FROM ebay_auctions WHERE auction_id=?', \
+                (a['auction_id'],))
+
+    # Construct and execute the new query
+    keys = ', '.join(a.keys())
+    filler = ('?, ' * (len(a)-1)) + '?'
+    vals = tuple(a.values())
+    query = f'INSERT INTO ebay_auctions ({keys}) VALUES ({filler})'
+    c.execute(query, vals)
+
+def _merge_and_write_profile_reference(c, profile, entries):
+    # Determine if a seller of the given id currently exists
+    c.execute('SELECT * FROM ebay_profiles WHERE profile_id=?',\
+            (profile['profile_id'],))
+    r = c.fetchall()
+    existing_entry = r[0] if r else None
+
+    existing_profile = {}
+    if existing_entry is not None:
+        # Merge existing entries
+        for name, e in zip(entries, existing_entry):
+            existing_profile[name] = e
+
+    # Assume the existing profile is older
+    p = {**existing_profile, **profile}
+
+    # Delete the row
+    if existing_entry is not None:
+        c.execute('DELETE FROM ebay_profiles WHERE profile_id=?', \
+                (p['profile_id'],))
+
+    # Update the row to its new values
+    c.execute('''
+        INSERT INTO ebay_profiles (
+            profile_id, description, contacted, location, registered,
+            permission_given, member_since, member_since_unix,
+            n_followers, n_reviews, percent_positive_feedback)
+        VALUES (?, ?, 0, ?, 0, 0, ?, ?, ?, ?, ?)''',
+        (p['profile_id'], p['description'], p['location'], \
+            p['member_since'], p['member_since_unix'], \
+            p['n_followers'], p['n_reviews'], \
+            p['percent_positive_feedback'])
+        )
+
+# How the merge rules of _merge_dicts treat a value, and the SQLite types of
+# the values it treats alike
+def _value_class(v):
+    if v is None:
+        return 'null'
+    if isinstance(v, Number):
+        return 'number'
+    if isinstance(v, str):
+        return 'text'
+    return 'other'
+
+_SQL_TYPES = {'number': "IN ('integer', 'real')", 'text': "= 'text'", \
+        'other': "= 'blob'"}
+
+# SQL for auction[k] > existing[k]: 1 or 0, or NULL where Python raises a
+# TypeError.  None if it always raises.  The unary + strips the column's
+# affinity, so values compare as Python's would.
+def _greater_sql(auction, k):
+    cls = _value_class(auction[k])
+    if cls == 'null':
+        return None
+    return 'CASE WHEN typeof(+ebay_auctions.{0}) {1} ' \
+            'THEN :{0} > +ebay_auctions.{0} END'.format(k, _SQL_TYPES[cls])
+
+# SQL for whether auction is newer than the existing row, following the
+# short-circuiting, KeyError and TypeError handling of the reference
+def _current_newer_sql(auction):
+    whens = []
+    def case(otherwise):
+        if not whens:
+            return otherwise
+        return 'CASE {} ELSE {} END'.format(' '.join(whens), otherwise)
+
+    for k in ['n_bids', 'end_time']:
+        if k not in auction:
+            return case('1')
+        greater = _greater_sql(auction, k)
+        if greater is None:
+            return case('0')
+        whens.append('WHEN ({0}) IS NULL THEN 0 WHEN ({0}) THEN 1' \
+                .format(greater))
+
+    if 'currency_code' not in auction:
+        return case('1')
+    whens.append('WHEN NOT (:currency_code IS +ebay_auctions.currency_code) ' \
+            'THEN 0')
+    if 'price' not in auction:
+        return case('1')
+    greater = _greater_sql(auction, 'price')
+    if greater is None:
+        return case('0')
+    whens.append('WHEN ({}) IS NULL THEN 0'.format(greater))
+    return case('({})'.format(greater))
+
+# SQL for _merge_dicts' merge of v2 into v1, for a column of the existing row
+# and a parameter of class cls
+def _merge_value_sql(v1, v2, cls, existing, param):
+    if cls == 'null':
+        return existing
+    error = 'ebay_merge_error({}, {})'.format(v1, v2)
+    if cls == 'number':
+        # The larger, or v1 if neither is
+        merged = 'CASE WHEN +{0} > +{1} THEN {0} ELSE {1} END'.format(v2, v1)
+    elif cls == 'text':
+        merged = v2
+    else:
+        merged = error
+    return 'CASE WHEN {0} IS NULL THEN {1} WHEN typeof(+{0}) {2} THEN {3} ' \
+            'ELSE {4} END'.format(existing, param, _SQL_TYPES[cls], merged, error)
+
+_upsert_sql_cache = {}
+
+# Returns the statement inserting auction, or merging it into its existing row
+# as _merge_and_write_auction_reference does.  The statement depends only on
+# the keys of auction and the types of their values, so is cached by them.
+def _auction_upsert_sql(auction):
+    signature = ('auction', tuple(auction), tuple(map(type, auction.values())))
+    try:
+        return _upsert_sql_cache[signature]
+    except KeyError:
+        pass
+
+    # Whether the auction is newer is found once, in a subquery, and each
+    # column merged one way or the other
+    columns = []
+    merged = []
+    for k, v in auction.items():
+        cls = _value_class(v)
+        if k == 'auction_id' or cls == 'null':
+            continue
+        existing = 'ebay_auctions.{}'.format(k)
+        param = ':{}'.format(k)
+        columns.append(k)
+        merged.append('CASE WHEN current_newer THEN {} ELSE {} END'.format( \
+                _merge_value_sql(existing, param, cls, existing, param), \
+                _merge_value_sql(param, existing, cls, existing, param)))
+
+    sql = 'INSERT INTO ebay_auctions ({}) VALUES ({}) ' \
+            'ON CONFLICT (auction_id) DO '.format(', '.join(auction), \
+            ', '.join(':' + k for k in auction))
+    if columns:
+        sql += 'UPDATE SET ({}) = (SELECT {} FROM (SELECT {} AS current_newer))' \
+                .format(', '.join(columns), ', '.join(merged), \
+                _current_newer_sql(auction))
+    else:
+        sql += 'NOTHING'
+    _upsert_sql_cache[signature] = sql
+    return sql
+
+# Returns the statement inserting auction, or overwriting the columns of its
+# existing row that auction has values for
+def _auction_replace_sql(auction):
+    signature = ('auction_replace', tuple(k for k, v in auction.items() \
+            if v is not None))
+    try:
+        return _upsert_sql_cache[signature]
+    except KeyError:
+        pass
+
+    columns = [k for k in signature[1] if k != 'auction_id']
+    sql = 'INSERT INTO ebay_auctions ({}) VALUES ({}) ' \
+            'ON CONFLICT (auction_id) DO '.format(', '.join(signature[1]), \
+            ', '.join(':' + k for k in signature[1]))
+    if columns:
+        sql += 'UPDATE SET ({}) = ({})'.format(', '.join(columns), \
+                ', '.join('excluded.' + k for k in columns))
+    else:
+        sql += 'NOTHING'
+    _upsert_sql_cache[signature] = sql
+    return sql
+
+_PROFILE_SCRAPED_COLUMNS = ['description', 'location', 'member_since', \
+        'member_since_unix', 'n_followers', 'n_reviews', \
+        'percent_positive_feedback']
+
+# Returns the statement inserting profile, or overwriting its existing row as
+# _merge_and_write_profile_reference does.  Scraped columns missing from
+# profile keep their existing values, as does last_scraped, and the contact
+# columns are reset.
+def _profile_upsert_sql(profile):
+    columns = _PROFILE_SCRAPED_COLUMNS + ['last_scraped']
+    signature = ('profile',) + tuple(k in profile for k in columns)
+    try:
+        return _upsert_sql_cache[signature]
+    except KeyError:
+        pass
+
+    present = [k for k in columns if k in profile]
+    sql = '''
+        INSERT INTO ebay_profiles (
+            profile_id, contacted, registered, permission_given{})
+        VALUES (:profile_id, 0, 0, 0{})
+        ON CONFLICT (profile_id) DO UPDATE SET
+            contacted = 0, registered = 0, permission_given = 0,
+            email = NULL, name = NULL{}
+    '''.format(''.join(', ' + k for k in present), \
+            ''.join(', :' + k for k in present), \
+            ''.join(', {0} = excluded.{0}'.format(k) for k in present))
+    _upsert_sql_cache[signature] = sql
+    return sql
+
+# The version of the schema below, recorded in the database's user_version.
+# Databases of earlier versions are migrated by _migrate.
+_SCHEMA_VERSION = 4
+
+_EBAY_AUCTIONS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {} (
+        auction_id INTEGER NOT NULL PRIMARY KEY,
+        title TEXT,
+        seller TEXT,   -- Primary key of sellers table
+        start_time INTEGER,
+        end_time INTEGER,
+        n_bids INTEGER,
+        price INTEGER,
+        currency_code TEXT,
+        buy_now_price INTEGER,
+        starting_price INTEGER,
+        winner TEXT,
+        location_id TEXT,  -- Primary key of locations table
+        description TEXT,
+        last_scraped INTEGER   -- Unix time its page was last scraped
+    )
+'''
+
+# Appends an image to those of its auction.  An image the auction already has
+# at the same path keeps its position, and takes any details now known.
+_APPEND_IMAGE_SQL = '''
+    INSERT INTO auction_images (auction_id, position, url, path, size, hash)
+    VALUES (:auction_id, (SELECT COALESCE(MAX(position) + 1, 0)
+        FROM auction_images WHERE auction_id = :auction_id),
+        :url, :path, :size, :hash)
+    ON CONFLICT (auction_id, path) DO UPDATE SET
+        url = COALESCE(excluded.url, url),
+        size = COALESCE(excluded.size, size),
+        hash = COALESCE(excluded.hash, hash)
+'''
+
+def _create_tables(c):
+    c.execute(_EBAY_AUCTIONS_TABLE_SQL.format('ebay_auctions'))
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS ebay_profiles (
+            profile_id TEXT NOT NULL PRIMARY KEY,
+            description TEXT,
+            contacted INTEGER NOT NULL,
+            email TEXT,
+            location TEXT,
+            name TEXT,
+            registered INTEGER,
+            permission_given INTEGER NOT NULL,
+            member_since TEXT,
+            member_since_unix INTEGER,
+            n_followers INTEGER,
+            n_reviews INTEGER,
+            percent_positive_feedback INTEGER,
+            last_scraped INTEGER   -- Unix time its page was last scraped
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS auction_images (
+            auction_id INTEGER NOT NULL,   -- Primary key of auctions table
+            position INTEGER NOT NULL,  -- Order of the image in its auction
+            url TEXT,
+            path TEXT NOT NULL,
+            size INTEGER,   -- In bytes
+            hash TEXT,  -- Hex SHA-256 of the image
+            PRIMARY KEY (auction_id, position)
+        )
+    ''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS auction_images_auction_path ' \
+            'ON auction_images (auction_id, path)')
+    c.execute('CREATE INDEX IF NOT EXISTS auction_images_path ' \
+            'ON auction_images (path)')
+    c.execute('CREATE INDEX IF NOT EXISTS auction_images_hash ' \
+            'ON auction_images (hash)')
+    c.execute('CREATE INDEX IF NOT EXISTS auction_images_url ' \
+            'ON auction_images (url)')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS image_phashes (
+            hash TEXT NOT NULL PRIMARY KEY,  -- Hash of auction_images table
+            phash INTEGER,  -- Signed 64-bit dHash, NULL if not an image
+            p0 INTEGER,  -- Its 16-bit chunks, most significant first
+            p1 INTEGER,
+            p2 INTEGER,
+            p3 INTEGER
+        )
+    ''')
+    for i in range(phash.CHUNKS):
+        c.execute('CREATE INDEX IF NOT EXISTS image_phashes_p{0} ' \
+                'ON image_phashes (p{0})'.format(i))
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_jobs (
+            job_id INTEGER NOT NULL PRIMARY KEY,
+            kind TEXT NOT NULL,  -- 'auction' or 'search'
+            args TEXT NOT NULL,  -- JSON of the arguments of the command
+            created INTEGER NOT NULL   -- Unix time
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_items (
+            job_id INTEGER NOT NULL,   -- Primary key of crawl_jobs table
+            kind TEXT NOT NULL,  -- 'auction', 'profile' or 'search'
+            item TEXT NOT NULL,  -- Auction, profile or query string
+            status TEXT NOT NULL DEFAULT 'pending',  -- One of CRAWL_STATUSES
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated INTEGER,   -- Unix time
+            PRIMARY KEY (job_id, kind, item)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS crawl_items_job_status ' \
+            'ON crawl_items (job_id, status)')
+
+    _migrate(c)
+
+    # Secondary indexes of ebay_auctions, serving query_auctions.  Made after
+    # the migration, which may rebuild the table.
+    c.execute('CREATE INDEX IF NOT EXISTS ebay_auctions_seller_end_time ' \
+            'ON ebay_auctions (seller, end_time)')
+    c.execute('CREATE INDEX IF NOT EXISTS ebay_auctions_end_time ' \
+            'ON ebay_auctions (end_time)')
+    c.execute('CREATE INDEX IF NOT EXISTS ebay_auctions_currency_price ' \
+            'ON ebay_auctions (currency_code, price)')
+
+    # The colon-separated image_paths column of ebay_auctions, as it was
+    # before version 1, for consumers still reading it
+    c.execute('''
+        CREATE VIEW IF NOT EXISTS ebay_auctions_with_image_paths AS
+        SELECT ebay_auctions.*, COALESCE((
+            SELECT group_concat(path, ':') FROM (
+                SELECT path FROM auction_images
+                WHERE auction_images.auction_id = ebay_auctions.auction_id
+                ORDER BY position)), '') AS image_paths
+        FROM ebay_auctions
+    ''')
+
+# Migrates the database through c from its user_version to _SCHEMA_VERSION
+def _migrate(c):
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    if version > _SCHEMA_VERSION:
+        raise ValueError('Database schema version {} is newer than {}' \
+                .format(version, _SCHEMA_VERSION))
+
+    if version < 1:
+        # Move the image_paths column of ebay_auctions into auction_images.
+        # The table is rebuilt without it, as SQLite before 3.35 cannot drop
+        # columns.
+        columns = [row[1] for row in \
+                c.execute("pragma table_info('ebay_auctions')").fetchall()]
+        if 'image_paths' in columns:
+            rows = c.execute('SELECT auction_id, image_paths ' \
+                    "FROM ebay_auctions WHERE image_paths != ''").fetchall()
+            for auction_id, image_paths in rows:
+                for path in _escape_split(image_paths, ':'):
+                    if not path:
+                        continue
+                    try:
+                        size = os.stat(path).st_size
+                    except OSError:
+                        size = None
+                    c.execute(_APPEND_IMAGE_SQL, {'auction_id': auction_id, \
+                            'url': None, 'path': path, 'size': size, \
+                            'hash': None})
+
+            c.execute(_EBAY_AUCTIONS_TABLE_SQL.format('ebay_auctions_migrated'))
+            columns = [row[1] for row in c.execute( \
+                    "pragma table_info('ebay_auctions_migrated')").fetchall() \
+                    if row[1] in columns]
+            c.execute('INSERT INTO ebay_auctions_migrated ({0}) ' \
+                    'SELECT {0} FROM ebay_auctions'.format(', '.join(columns)))
+            c.execute('DROP TABLE ebay_auctions')
+            c.execute('ALTER TABLE ebay_auctions_migrated ' \
+                    'RENAME TO ebay_auctions')
+
+    if version < 2:
+        # Index the titles and descriptions of existing auctions
+        if _create_search_index(c):
+            _rebuild_search_index(c)
+
+    if version < 3:
+        # Auctions scraped before are due to be refreshed
+        columns = [row[1] for row in \
+                c.execute("pragma table_info('ebay_auctions')").fetchall()]
+        if 'last_scraped' not in columns:
+            c.execute('ALTER TABLE ebay_auctions ' \
+                    'ADD COLUMN last_scraped INTEGER')
+
+    if version < 4:
+        # Profiles scraped before are stale
+        columns = [row[1] for row in \
+                c.execute("pragma table_info('ebay_profiles')").fetchall()]
+        if 'last_scraped' not in columns:
+            c.execute('ALTER TABLE ebay_profiles ' \
+                    'ADD COLUMN last_scraped INTEGER')
+
+    c.execute('PRAGMA user_version = {}'.format(_SCHEMA_VERSION))
+
+# Creates ebay_auctions_fts, a full-text index of the titles and descriptions
+# of ebay_auctions, with the triggers that keep it in step with the table.
+# Returns False, having created nothing, if SQLite was built without FTS5.
+def _create_search_index(c):
+    try:
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS ebay_auctions_fts USING fts5(
+                title, description, content='ebay_auctions',
+                content_rowid='auction_id',
+                tokenize='porter unicode61 remove_diacritics 2')
+        ''')
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        print(colored('SQLite lacks FTS5, so auctions cannot be searched ' \
+                'locally', 'red'))
+        return False
+
+    # The index holds no text of its own, so each change to the table is
+    # mirrored by deleting the old text from it and adding the new
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS ebay_auctions_fts_insert
+        AFTER INSERT ON ebay_auctions BEGIN
+            INSERT INTO ebay_auctions_fts (rowid, title, description)
+            VALUES (new.auction_id, new.title, new.description);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS ebay_auctions_fts_delete
+        AFTER DELETE ON ebay_auctions BEGIN
+            INSERT INTO ebay_auctions_fts (
+                ebay_auctions_fts, rowid, title, description)
+            VALUES ('delete', old.auction_id, old.title, old.description);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS ebay_auctions_fts_update
+        AFTER UPDATE OF auction_id, title, description ON ebay_auctions BEGIN
+            INSERT INTO ebay_auctions_fts (
+                ebay_auctions_fts, rowid, title, description)
+            VALUES ('delete', old.auction_id, old.title, old.description);
+            INSERT INTO ebay_auctions_fts (rowid, title, description)
+            VALUES (new.auction_id, new.title, new.description);
+        END
+    ''')
+    return True
+
+# Rebuilds ebay_auctions_fts from the contents of ebay_auctions
+def _rebuild_search_index(c):
+    c.execute("INSERT INTO ebay_auctions_fts (ebay_auctions_fts) " \
+            "VALUES ('rebuild')")
+    c.execute("INSERT INTO ebay_auctions_fts (ebay_auctions_fts) " \
+            "VALUES ('optimize')")
+
+# Returns the statement and parameters selecting the auctions matching the
+# FTS5 query, best first, with a snippet of the text matched
+def _search_local_sql(query, limit):
+    # Matches in titles count double
+    return '''
+        SELECT ebay_auctions.auction_id, ebay_auctions.title,
+            ebay_auctions.seller, ebay_auctions.end_time, ebay_auctions.price,
+            ebay_auctions.currency_code,
+            bm25(ebay_auctions_fts, 2.0, 1.0) AS rank,
+            snippet(ebay_auctions_fts, -1, '[', ']', '...', 16) AS snippet
+        FROM ebay_auctions_fts
+        JOIN ebay_auctions ON ebay_auctions.auction_id = ebay_auctions_fts.rowid
+        WHERE ebay_auctions_fts MATCH ?
+        ORDER BY rank LIMIT ?
+    ''', [query, limit]
+
+# The states of the items of a crawl job.  Items are pending until they are
+# started, in flight until they finish, and then done or failed.
+CRAWL_STATUSES = ['pending', 'in_flight', 'done', 'failed']
+
+# Columns the results of query_auctions can be ordered by
+QUERY_ORDERS = ['auction_id', 'end_time', 'price', 'n_bids']
+
+# Returns the statement and parameters selecting the auctions matching every
+# filter given to query_auctions
+def _query_auctions_sql(seller=None, ended_after=None, ended_before=None, \
+        min_price=None, max_price=None, currency_code=None, min_bids=None, \
+        max_bids=None, order_by=None, limit=None):
+    conditions = []
+    params = []
+    for condition, param in [('seller = ?', seller), \
+            ('end_time >= ?', ended_after), ('end_time < ?', ended_before), \
+            ('currency_code = ?', currency_code), ('price >= ?', min_price), \
+            ('price <= ?', max_price), ('n_bids >= ?', min_bids), \
+            ('n_bids <= ?', max_bids)]:
+        if param is not None:
+            conditions.append(condition)
+            params.append(param)
+
+    sql = 'SELECT * FROM ebay_auctions'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if order_by is not None:
+        if order_by not in QUERY_ORDERS:
+            raise ValueError('order_by must be one of {}'.format(QUERY_ORDERS))
+        sql += ' ORDER BY {}, auction_id'.format(order_by)
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
+
+# An auction being refreshed is scraped again after this fraction of the time
+# it had left when last scraped, and once more this many seconds after it ends
+_REFRESH_FRACTION = 0.1
+_REFRESH_END_GRACE = 60
+
+# Returns the unix time an auction should next be scraped, or None if it has
+# been scraped since it ended.  Auctions are scraped more often the closer
+# they are to ending, at intervals within [min_interval, max_interval], twice
+# as long for those without bids.  Those never scraped are due at once, and
+# those of unknown end every max_interval.
+def _next_refresh(end_time, n_bids, last_scraped, min_interval, max_interval):
+    if last_scraped is None:
+        return 0
+    if end_time is None:
+        return last_scraped + max_interval
+    if last_scraped >= end_time + _REFRESH_END_GRACE:
+        return None
+    interval = (end_time - last_scraped) * _REFRESH_FRACTION
+    if not n_bids:
+        interval *= 2
+    interval = min(max(interval, min_interval), max_interval)
+    return min(last_scraped + interval, end_time + _REFRESH_END_GRACE)
+
+# Images hashed per task sent to a perceptual hashing worker
+_PHASH_CHUNK_SIZE = 16
+
+# Returns (path, hash, phash, error) for the image at path, finding its hash
+# if it is None.  phash is None if it is not an image Pillow can read, and
+# hash too if it is missing.
+def _phash_image(item):
+    path, h = item
+    if not os.path.isfile(path):
+        return path, None, None, 'No such file'
+    try:
+        if h is None:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(_IMAGE_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            h = sha256.hexdigest()
+        return path, h, phash.dhash(path), None
+    except Exception as e:
+        return path, h, None, repr(e)
+
+# Returns the statement and parameters selecting the hash and phash of every
+# image within max_distance of h, and perhaps some further away
+def _phash_candidates_sql(h, max_distance):
+    radius = max_distance // phash.CHUNKS
+    conditions = []
+    params = []
+    for i, chunk in enumerate(phash.chunks(h)):
+        neighbours = phash.chunk_neighbours(chunk, radius)
+        conditions.append('p{} IN ({})'.format(i, \
+                ', '.join('?' * len(neighbours))))
+        params.extend(neighbours)
+    return 'SELECT hash, phash FROM image_phashes WHERE ' + \
+            ' OR '.join(conditions), params
+
+# Pages parsed per task sent to a reparse worker
+_REPARSE_CHUNK_SIZE = 16
+
+# The archive and settings of each reparse worker process
+_reparse_state = {}
+
+def _init_reparse(archive_location, html_parser, formats):
+    _reparse_state['archive'] = PageArchive(archive_location)
+    _reparse_state['html_parser'] = html_parser
+    _reparse_state['formats'] = formats
+
+# Parses the auction page item, an archive record or the path of a page saved
+# as HTML.  Returns (page_id, page_format, auction, error), where auction is
+# None if the page is not of one of the formats wanted or fails to parse.
+def _reparse_page(item):
+    page_id, source = item
+    page_format = None
+    try:
+        if isinstance(source, dict):
+            soup = scraper._archived_page_soup(_reparse_state['archive'], \
+                    source, _reparse_state['html_parser'])
+        else:
+            with open(source, 'rb') as f:
+                soup = scraper._make_soup(f.read().decode(errors='ignore'), \
+                        _reparse_state['html_parser'])
+        page_format = scraper._detect_auction_format(soup)
+        formats = _reparse_state['formats']
+        if formats is not None and page_format not in formats:
+            return page_id, page_format, None, None
+        a = scraper._parse_auction_page(soup, ['maxImageUrl', 'displayImgUrl'])
+    except Exception as e:
+        # Exceptions are passed back as text, as not all of them pickle
+        return page_id, page_format, None, repr(e)
+    return page_id, page_format, a, None
+
 class EbayScraper():
-    def __init__(self, db_path, save_location=None):
+    def __init__(self, db_path, save_location=None, transport=None, \
+            image_concurrency: int = 4, html_parser: str = 'html.parser', \
+            batch_size: int = 64, flush_interval: float = 0.5, \
+            archive_compression: str = 'gzip', profile_ttl: float = 86400):
         self.db_path = db_path
+        # Profiles scraped more recently are not fetched again
+        self.profile_ttl = profile_ttl
+        # All fetches share one pooled, keep-alive HTTP transport
+        self.transport = transport if transport is not None else Transport()
 
-        @self._db_transaction
-        def _(c):
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS ebay_auctions (
-                    auction_id INTEGER NOT NULL PRIMARY KEY,
-                    title TEXT,
-                    seller TEXT,   -- Primary key of sellers table
-                    start_time INTEGER,
-                    end_time INTEGER,
-                    n_bids INTEGER,
-                    price INTEGER,
-                    currency_code TEXT,
-                    buy_now_price INTEGER,
-                    starting_price INTEGER,
-                    winner TEXT,
-                    location_id TEXT,  -- Primary key of locations table
-                    image_paths TEXT NOT NULL, -- colon-separated paths relative to some base path
-                    description TEXT
-                )
-            ''')
-
-            c.execute('''
-            CREATE TABLE IF NOT EXISTS ebay_profiles (
-                    profile_id TEXT NOT NULL PRIMARY KEY,
-                    description TEXT,
-                    contacted INTEGER NOT NULL,
-                    email TEXT,
-                    location TEXT,
-                    name TEXT,
-                    registered INTEGER,
-                    permission_given INTEGER NOT NULL,
-                    member_since TEXT,
-                    member_since_unix INTEGER,
-                    n_followers INTEGER,
-                    n_reviews INTEGER,
-                    percent_positive_feedback INTEGER
-
-                )
-            ''')
+        # The backend BeautifulSoup parses every page with
+        if html_parser not in scraper.HTML_PARSERS:
+            raise ValueError('html_parser must be one of {}' \
+                    .format(scraper.HTML_PARSERS))
+        self.html_parser = html_parser
 
+        # Fetched pages are stored compressed in pack files
+        self.archive = PageArchive(pathlib.Path(save_location) \
+                .joinpath('ebay', 'archive'), archive_compression)
 
-        @self._db_transaction
+        # Images of all auctions are downloaded by one bounded pool
+        if image_concurrency < 1:
+            raise ValueError('image_concurrency must be at least 1')
+        self._image_executor = ThreadPoolExecutor(max_workers=image_concurrency)
+        # Downloads in progress, by URL, shared by the auctions wanting them
+        self._image_lock = threading.Lock()
+        self._image_downloads = {}
+
+        # One connection, in WAL mode, is held open for the scraper's life.
+        # All writes are made by a single writer thread, which commits up to
+        # batch_size of them at a time, waiting at most flush_interval seconds
+        # after the first for others to join it.
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(db_path, timeout=30, \
+                check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._merge_error = None
+        self._conn.create_function('ebay_merge_error', 2, \
+                self._record_merge_error)
+        # Held by the writer for each batch, and by each read
+        self._conn_lock = threading.Lock()
+        self._write_queue = queue.Queue()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_batches, \
+                name='EbayScraper-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+        # Create the tables, or migrate those of an older schema
+        self._db_transaction(_create_tables)
+
+        @self._db_read
         def ebay_auctions_entries(c):
             return [row[1] for row in \
                 c.execute("pragma table_info('ebay_auctions')").fetchall()]
         self.ebay_auctions_entries = ebay_auctions_entries
 
-        @self._db_transaction
+        @self._db_read
         def ebay_profiles_entries(c):
             return [row[1] for row in \
                 c.execute("pragma table_info('ebay_profiles')").fetchall()]
         self.ebay_profiles_entries = ebay_profiles_entries
 
         save_path = pathlib.Path(save_location).joinpath('ebay')
-        self.image_location = save_path.joinpath('images')
-        pathlib.Path(self.image_location).mkdir(parents=True, exist_ok=True)
+        self.image_location = save_path.joinpath('images').resolve()
+        self.image_location.mkdir(parents=True, exist_ok=True)
+        # Pages saved as prettified HTML, before the archive
         self.auction_page_location = save_path.joinpath('auctions')
-        pathlib.Path(self.auction_page_location).mkdir(parents=True, exist_ok=True)
         self.profile_page_location = save_path.joinpath('profiles')
-        pathlib.Path(self.profile_page_location).mkdir(parents=True, exist_ok=True)
 
+    # Queues f(c) to be run by the writer thread, within a transaction, and
+    # returns a Future of its result.  The writes of f are rolled back if it
+    # raises, without affecting others in the same batch.
+    def _db_write(self, f):
+        if self._closed:
+            raise ValueError('EbayScraper is closed')
+        future = Future()
+        self._write_queue.put((f, future))
+        return future
+
+    # As _db_write, reporting rather than raising any failure
+    def _db_write_async(self, f):
+        def report(future):
+            e = future.exception()
+            if e is not None:
+                print(colored('Could not write to the database: {!r}' \
+                        .format(e), 'red'))
+        future = self._db_write(f)
+        future.add_done_callback(report)
+        return future
+
+    # Runs an upsert statement.  Merge errors raised within it by
+    # ebay_merge_error are raised as the ValueError _merge_dicts would raise.
+    def _upsert(self, c, sql, values):
+        try:
+            c.execute(sql, values)
+        except sqlite3.OperationalError:
+            if self._merge_error is not None:
+                e, self._merge_error = self._merge_error, None
+                raise e
+            raise
+
+    def _record_merge_error(self, v1, v2):
+        if type(v1) != type(v2):
+            e = ValueError('{} and {} not of same types: {}, {}'.format(\
+                    v1, v2, type(v1), type(v2)))
+        else:
+            e = ValueError('Unknown failure between {}:{} and {}:{}'\
+                    .format(v1, type(v1), v2, type(v2)))
+        # Only the writer thread runs statements, so one slot suffices
+        self._merge_error = e
+        raise e
+
+    # Runs f(c) as a write, committing it at once
     def _db_transaction(self, f):
-        for _ in range(5):
-            try:
-                conn = sqlite3.connect(self.db_path)
-                c = conn.execute('''BEGIN TRANSACTION''')
+        future = self._db_write(f)
+        self.flush()
+        return future.result()
+
+    # Runs f(c) on the connection, once every write queued so far is committed
+    def _db_read(self, f):
+        self.flush()
+        with self._conn_lock:
+            return f(self._conn.cursor())
+
+    # Yields the rows of sql as dicts, as they are read, once every write
+    # queued so far is committed.  They are read through a connection of their
+    # own, so the writer is not held up while they are consumed.
+    def _db_iter(self, sql, params):
+        self.flush()
+        conn = sqlite3.connect(pathlib.Path(self.db_path).resolve().as_uri() \
+                + '?mode=ro', uri=True, timeout=30)
+        try:
+            c = conn.execute(sql, params)
+            names = [d[0] for d in c.description]
+            for row in c:
+                yield dict(zip(names, row))
+        finally:
+            conn.close()
+
+    # Blocks until every write queued so far is committed
+    def flush(self):
+        if not self._closed:
+            future = Future()
+            self._write_queue.put((None, future))
+            future.result()
+
+    def _write_batches(self):
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # A flush commits the batch at once
+            while len(batch) < self.batch_size and batch[-1][0] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
                 try:
-                    result = f(c)
-                    conn.commit()
-                except:
-                    conn.rollback()
-                    raise
-                finally:
+                    item = self._write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        results = []
+        with self._conn_lock:
+            c = self._conn.cursor()
+            try:
+                c.execute('BEGIN IMMEDIATE TRANSACTION')
+                for f, future in batch:
+                    if f is None:
+                        results.append((future, None, None))
+                        continue
+                    c.execute('SAVEPOINT write')
                     try:
-                        conn.close()
-                    except:
-                        os.abort()
-            except sqlite3.OperationalError as e:
-                pass
+                        result = f(c)
+                    except Exception as e:
+                        c.execute('ROLLBACK TO write')
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    c.execute('RELEASE write')
+                c.execute('COMMIT')
+            except Exception as e:
+                if self._conn.in_transaction:
+                    self._conn.rollback()
+                results = [(future, None, e) for _, future in batch]
+
+        # Results are only given once they are committed
+        for future, result, e in results:
+            if e is None:
+                future.set_result(result)
             else:
-                return result
-        c = sqlite3.connect(self.db_path)
+                future.set_exception(e)
+
+    def close(self):
+        if self._closed:
+            return
+        self._image_executor.shutdown()
+        self._closed = True
+        self._write_queue.put(None)
+        self._writer.join()
+        self._conn.close()
+        self.archive.close()
+        atexit.unregister(self.close)
+
+    # Returns the path in the image store of the image of hash h, fetched
+    # from url.  Images are stored once, under their hash, keeping the
+    # extension of their URL.
+    def _image_path(self, h, url):
+        suffix = pathlib.PurePosixPath(urlparse(url).path).suffix
+        if not suffix[1:].isalnum():
+            suffix = ''
+        return self.image_location.joinpath(h[:2], h + suffix)
+
+    # Streams url into the image store through a temporary file, so that a
+    # partial or failed download never leaves a file there.  Bytes already
+    # stored are not stored again.  Returns the image's auction_images row,
+    # without its auction.
+    def _download_image(self, url):
+        r = self.transport.get(url, stream=True)
         try:
-            c.execute('''BEGIN EXCLUSIVE TRANSACTION''')
-            result = f(c)
-            c.commit()
+            if not r.ok:
+                raise ValueError('Could not find page: {} ({})'.format(url, \
+                        r.status_code))
+            tmp_path = self.image_location.joinpath('.{}.part'.format( \
+                    uuid.uuid4().hex))
+            size = 0
+            h = hashlib.sha256()
+            try:
+                with open(tmp_path, 'xb') as f:
+                    for chunk in r.iter_content(chunk_size=_IMAGE_CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+                        h.update(chunk)
+                path = self._image_path(h.hexdigest(), url)
+                if path.is_file():
+                    os.unlink(tmp_path)
+                else:
+                    path.parent.mkdir(exist_ok=True)
+                    os.replace(tmp_path, path)
+            except BaseException:
+                if tmp_path.exists():
+                    os.unlink(tmp_path)
+                raise
         finally:
-            c.close()
+            r.close()
+        return {'url': url, 'path': str(path), 'size': size, \
+                'hash': h.hexdigest()}
+
+    # Returns the auction_images rows, without their auctions, of the images
+    # already downloaded from urls that are still on disk, by URL
+    def _known_images(self, urls):
+        @self._db_read
+        def rows(c):
+            return c.execute('SELECT url, path, size, hash FROM ' \
+                    'auction_images WHERE hash IS NOT NULL AND url IN ({})' \
+                    .format(', '.join('?' * len(urls))), urls).fetchall()
+
+        known = {}
+        for url, path, size, h in rows:
+            # Images downloaded before the store are used where they are
+            for path in [self._image_path(h, url), pathlib.Path(path)]:
+                if path.is_file():
+                    known[url] = {'url': url, 'path': str(path), \
+                            'size': size, 'hash': h}
+                    break
+        return known
 
-    def _download_images(self, image_urls, auction_id,  name_prefix: str = 'ebay'):
-        self.image_location = pathlib.Path(self.image_location)
-        image_paths = []
+    # Adds the images of image_urls to those of the auction, downloading
+    # only those whose URL is not already known, and each only once however
+    # many auctions want it at the same time.  Images that could not be
+    # downloaded are reported and left out.  Returns the auction_images rows
+    # queued.
+    def _store_images(self, image_urls, auction_id):
+        image_urls = list(dict.fromkeys(image_urls))
+        known = self._known_images(image_urls)
+        futures = {}
+        started = []
+        with self._image_lock:
+            for url in image_urls:
+                if url in known:
+                    continue
+                future = self._image_downloads.get(url)
+                if future is None:
+                    future = self._image_executor.submit( \
+                            self._download_image, url)
+                    self._image_downloads[url] = future
+                    started.append(url)
+                futures[url] = future
+
+        images = []
         for url in image_urls:
-            name = name_prefix + '_' + str(auction_id) + \
-                    '_' + '_'.join(urlparse(url).path.split('/')[-2:])
-            path = self.image_location.joinpath(name).resolve()
-            image_paths.append(path)
+            try:
+                image = known[url] if url in known else futures[url].result()
+            except Exception as e:
+                print(colored('Could not download image for auction {}: {}' \
+                        .format(auction_id, e), 'red'))
+                continue
+            images.append(dict(image, auction_id=auction_id))
 
-            if not pathlib.Path(path).is_file():
-                r = requests.get(url)
-                if not r.ok:
-                    print(colored('Could not find page: {}'.format(url), 'red'))
-                with open(path, 'wb') as f:
-                    f.write(r.content)
-        return image_paths
+        if images:
+            @self._db_write_async
+            def _(c):
+                c.executemany(_APPEND_IMAGE_SQL, images)
 
+        # The downloads are now found by _known_images, once written
+        with self._image_lock:
+            for url in started:
+                del self._image_downloads[url]
+        return images
 
-    def _merge_and_write_auction(self, auction: dict):
-        # Determine if an auction of the given id currently exists
+    # Records a new crawl job of kind, 'auction' or 'search', run with args,
+    # and returns its ID
+    def create_crawl_job(self, kind: str, args: dict):
+        if kind not in ['auction', 'search']:
+            raise ValueError("kind must be 'auction' or 'search'")
         @self._db_transaction
-        def existing_entry(c):
-            c.execute('SELECT * FROM ebay_auctions WHERE auction_id=?',\
-                    (auction['auction_id'],))
-            r = c.fetchall()
-            if not r:
-                return None
-            else:
-                return r[0]
-
-        existing_auction = {}
-        if existing_entry is not None:
-            # Merge existing entries
-            for name, e in zip(self.ebay_auctions_entries, existing_entry):
-                existing_auction[name] = e
-
-        # Determine whether auction or existing_auction is newer
-        current_newer = False
-        if existing_entry is not None:
-            # Determine which entry is newer
-            try:
-                current_newer = auction['n_bids'] > existing_auction['n_bids'] \
-                        or auction['end_time'] > existing_auction['end_time'] \
-                        or (auction['currency_code'] == \
-                            existing_auction['currency_code'] \
-                        and auction['price'] > existing_auction['price'])
-            except TypeError:
-                # Short-circuiting of previous expressions will fail if evaluates
-                # in place of None
-                pass
-            except KeyError:
-                # existing auction must have failed, so the current is newer
-                current_newer = True
-        
-        if current_newer:
-            a = _merge_dicts(existing_auction, auction)
+        def job_id(c):
+            c.execute('INSERT INTO crawl_jobs (kind, args, created) ' \
+                    'VALUES (?, ?, ?)', (kind, json.dumps(args), \
+                    int(time.time())))
+            return c.lastrowid
+        return job_id
+
+    # Returns the crawl job job_id as a dict, with its args and the number of
+    # its items of each status
+    def crawl_job(self, job_id: int):
+        @self._db_read
+        def job(c):
+            row = c.execute('SELECT job_id, kind, args, created ' \
+                    'FROM crawl_jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                raise ValueError('No crawl job {}'.format(job_id))
+            job = dict(zip(['job_id', 'kind', 'args', 'created'], row))
+            job['args'] = json.loads(job['args'])
+            job['items'] = dict.fromkeys(CRAWL_STATUSES, 0)
+            job['items'].update(c.execute('SELECT status, COUNT(*) ' \
+                    'FROM crawl_items WHERE job_id = ? GROUP BY status', \
+                    (job_id,)).fetchall())
+            return job
+        return job
+
+    # Returns the IDs of every crawl job, oldest first
+    def crawl_jobs(self):
+        return self._db_read(lambda c: [row[0] for row in \
+                c.execute('SELECT job_id FROM crawl_jobs ORDER BY job_id')])
+
+    # Queues items of kind to be crawled by the job, unless it has them
+    def _add_crawl_items(self, job_id, kind, items):
+        rows = [(job_id, kind, str(item)) for item in items]
+        self._db_write_async(lambda c: c.executemany('INSERT OR IGNORE ' \
+                'INTO crawl_items (job_id, kind, item) VALUES (?, ?, ?)', rows))
+
+    # Returns the items of kind of the job that are done, or if max_attempts
+    # is given, those still to do: those pending, and those in flight, as
+    # when the run was stopped, or failed, with fewer than max_attempts
+    def _crawl_items(self, job_id, kind, max_attempts=None):
+        if max_attempts is None:
+            sql = "status = 'done'"
+            params = []
         else:
-            a = _merge_dicts(auction, existing_auction)
+            sql = "status = 'pending' OR (status IN ('in_flight', 'failed') " \
+                    'AND attempts < ?)'
+            params = [max_attempts]
+        return self._db_read(lambda c: [row[0] for row in c.execute( \
+                'SELECT item FROM crawl_items WHERE job_id = ? AND kind = ? ' \
+                'AND ({})'.format(sql), [job_id, kind] + params)])
 
-        # Write out to self.db_path
-        @self._db_transaction
+    # Returns f(), recording the item of kind as in flight while it runs, and
+    # as done or failed after, if job_id is given
+    def _crawl(self, job_id, kind, item, f):
+        if job_id is None:
+            return f()
+
+        def update(status, error=None, attempt=0):
+            self._db_write_async(lambda c: c.execute('UPDATE crawl_items ' \
+                    'SET status = ?, attempts = attempts + ?, ' \
+                    'last_error = ?, updated = ? WHERE job_id = ? AND ' \
+                    'kind = ? AND item = ?', (status, attempt, error, \
+                    int(time.time()), job_id, kind, str(item))))
+
+        update('in_flight', attempt=1)
+        try:
+            result = f()
+        except Exception as e:
+            update('failed', repr(e))
+            raise
+        update('done')
+        return result
+
+    # Queues the merge of auction into its row
+    def _merge_and_write_auction(self, auction: dict):
+        @self._db_write_async
         def _(c):
-            # Delete the row
-            if existing_entry is not None:
-                c.execute('DELETE FROM ebay_auctions WHERE auction_id=?', \
-                        (a['auction_id'],))
-
-            # Construct and execute the new query
-            keys = ', '.join(a.keys())
-            filler = ('?, ' * (len(a)-1)) + '?'
-            vals = tuple(a.values())
-            query = f'INSERT INTO ebay_auctions ({keys}) VALUES ({filler})'
-            c.execute(query, vals)
+            self._upsert(c, _auction_upsert_sql(auction), auction)
 
     # Some method to write out to the database
     def scrape_auction_to_db(self, auction, base: str = 'https://www.ebay.com'):
         auction_dict = scraper.scrape_auction_page(auction, base, \
-                page_save_path=self.auction_page_location)
+                archive=self.archive, \
+                transport=self.transport, html_parser=self.html_parser)
+        auction_dict['last_scraped'] = int(time.time())
         try:
             image_urls = auction_dict['image_urls']
         except KeyError:
@@ -242,97 +1145,444 @@ class EbayScraper():
         auction_dict = {k:v for k,v in auction_dict.items() if \
                 k in self.ebay_auctions_entries}
 
-        # Set NOT NULL constraint keys to their defaults
-        if 'image_paths' not in auction_dict.keys():
-            auction_dict['image_paths'] = ''
-
         self._merge_and_write_auction(auction_dict)
 
-        # Grab images and save them
-        if image_urls is not None:
-            new_image_paths = list(map(str, self._download_images(image_urls, \
-                    auction_dict['auction_id'])))
-            try:
-                existing_image_paths = _escape_split(auction_dict['image_paths'], ':')
-            except KeyError:
-                existing_image_paths = []
-            image_paths = ':'.join(list(set(new_image_paths).union(existing_image_paths)))
-
-            @self._db_transaction
-            def _(c):
-                c.execute('''
-                    UPDATE ebay_auctions SET image_paths=?
-                    WHERE auction_id=?
-                ''', (image_paths, auction_dict['auction_id'],))
+        # Grab images and append them to the auction's
+        if image_urls:
+            self._store_images(image_urls, auction_dict['auction_id'])
 
         return auction_dict
 
+    # Scrapes many auctions into the database, using up to concurrency worker
+    # threads.  Yields (auction, auction_dict, exception) as each completes,
+    # where exactly one of auction_dict and exception is None.  If job_id is
+    # given, the progress of each auction is recorded against that crawl job.
+    def scrape_auctions_to_db(self, auctions, base: str = 'https://www.ebay.com', \
+            concurrency: int = 1, job_id: int = None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        if job_id is not None:
+            auctions = list(auctions)
+            self._add_crawl_items(job_id, 'auction', auctions)
 
-    def _merge_and_write_profile(self, profile):
-        # Determine if a seller of the given id currently exists
-        @self._db_transaction
-        def existing_entry(c):
-            c.execute('SELECT * FROM ebay_profiles WHERE profile_id=?',\
-                    (profile['profile_id'],))
-            r = c.fetchall()
-            if not r:
-                return None
-            else:
-                return r[0]
+        def scrape(a):
+            return self._crawl(job_id, 'auction', a, \
+                    lambda: self.scrape_auction_to_db(a, base))
 
-        existing_profile = {}
-        if existing_entry is not None:
-            # Merge existing entries
-            for name, e in zip(self.ebay_profiles_entries, existing_entry):
-                existing_profile[name] = e
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(scrape, a): a for a in auctions}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield futures[future], None, e
+                else:
+                    yield futures[future], result, None
 
-        # Assume the existing profile is older
-        p = {**existing_profile, **profile}
+    # Scrapes the auctions of the database again as they fall due, as given
+    # by _next_refresh, the soonest first, using up to concurrency worker
+    # threads.  Runs until the unix time until, or if not given, until none
+    # are due.  Auctions that fail are tried again after max_interval.
+    # Yields (auction_id, auction_dict, exception) as each completes, as for
+    # scrape_auctions_to_db.
+    def refresh_auctions(self, base: str = 'https://www.ebay.com', \
+            concurrency: int = 1, min_interval: float = 300, \
+            max_interval: float = 86400, until: float = None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError('min_interval must be positive and at most ' \
+                    'max_interval')
 
-        # Write out to self.db_path
+        # Auctions scraped since they ended are never scheduled
+        @self._db_read
+        def rows(c):
+            return c.execute('SELECT auction_id, end_time, n_bids, ' \
+                    'last_scraped FROM ebay_auctions WHERE ' \
+                    'last_scraped IS NULL OR end_time IS NULL OR ' \
+                    'last_scraped < end_time + ?', \
+                    (_REFRESH_END_GRACE,)).fetchall()
+        schedule = []
+        for auction_id, end_time, n_bids, last_scraped in rows:
+            due = _next_refresh(end_time, n_bids, last_scraped, \
+                    min_interval, max_interval)
+            if due is not None:
+                schedule.append((due, auction_id))
+        heapq.heapify(schedule)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {}
+            while schedule or futures:
+                # Start every auction due, up to concurrency at a time
+                now = time.time()
+                while schedule and schedule[0][0] <= now and \
+                        len(futures) < concurrency:
+                    _, auction_id = heapq.heappop(schedule)
+                    futures[executor.submit(self.scrape_auction_to_db, \
+                            auction_id, base)] = auction_id
+                if not futures:
+                    if until is None or schedule[0][0] >= until:
+                        return
+                    time.sleep(min(schedule[0][0], until) - now)
+                    continue
+
+                # Wait for one to finish, or the next to fall due
+                timeout = None
+                if schedule and len(futures) < concurrency:
+                    timeout = max(schedule[0][0] - now, 0)
+                done, _ = wait(futures, timeout=timeout, \
+                        return_when=FIRST_COMPLETED)
+                for future in done:
+                    auction_id = futures.pop(future)
+                    try:
+                        a = future.result()
+                    except Exception as e:
+                        due = time.time() + max_interval
+                        yield auction_id, None, e
+                    else:
+                        due = _next_refresh(a.get('end_time'), \
+                                a.get('n_bids'), a['last_scraped'], \
+                                min_interval, max_interval)
+                        yield auction_id, a, None
+                    if due is not None and until is not None and due < until:
+                        heapq.heappush(schedule, (due, auction_id))
+
+    # Computes the perceptual hashes of the images downloaded that have none,
+    # in jobs worker processes, and adds them to the index searched by
+    # find_duplicate_auctions.  Images downloaded before their hashes were
+    # recorded are hashed too.  Yields (path, error) for each image, where
+    # error is None if it was indexed.
+    def index_images(self, jobs: int = None):
+        if phash.Image is None:
+            raise ValueError('Perceptual hashing requires Pillow to be ' \
+                    'installed')
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs < 1:
+            raise ValueError('jobs must be at least 1')
+
+        @self._db_read
+        def images(c):
+            return c.execute('SELECT path, MAX(hash) FROM auction_images ' \
+                    'LEFT JOIN image_phashes USING (hash) ' \
+                    'WHERE image_phashes.hash IS NULL GROUP BY path').fetchall()
+
+        def write(path, h, p):
+            def f(c):
+                if p is None:
+                    chunks = [None] * phash.CHUNKS
+                else:
+                    chunks = phash.chunks(p)
+                    p = phash.to_signed(p)
+                c.execute('UPDATE auction_images SET hash = ? ' \
+                        'WHERE path = ? AND hash IS NULL', (h, path))
+                c.execute('INSERT OR REPLACE INTO image_phashes (hash, ' \
+                        'phash, {}) VALUES (?, ?, {})'.format(', '.join( \
+                        'p{}'.format(i) for i in range(phash.CHUNKS)), \
+                        ', '.join('?' * phash.CHUNKS)), [h, p] + chunks)
+            return f
+
+        with multiprocessing.Pool(jobs) as pool:
+            for path, h, p, error in pool.imap_unordered(_phash_image, \
+                    images, _PHASH_CHUNK_SIZE):
+                # Files that are missing are left to be hashed when they are
+                # downloaded again
+                if h is not None:
+                    self._db_write_async(write(path, h, p))
+                yield path, error
+
+    # Returns the auctions with an image within a Hamming distance of
+    # max_distance, at most phash.MAX_DISTANCE, of one of auction_id's, as
+    # dicts of their auction_id, title, seller, the distance of their closest
+    # image and their number of images within it, closest first.
+    def find_duplicate_auctions(self, auction_id: int, max_distance: int = 6, \
+            limit: int = None):
+        if not 0 <= max_distance <= phash.MAX_DISTANCE:
+            raise ValueError('max_distance must be from 0 to {}' \
+                    .format(phash.MAX_DISTANCE))
+
+        @self._db_read
+        def auctions(c):
+            phashes = [phash.to_unsigned(row[0]) for row in c.execute( \
+                    'SELECT DISTINCT phash FROM auction_images ' \
+                    'JOIN image_phashes USING (hash) ' \
+                    'WHERE auction_id = ? AND phash IS NOT NULL', \
+                    (auction_id,))]
+
+            # The distance of each image near one of the auction's
+            distances = {}
+            for p in phashes:
+                sql, params = _phash_candidates_sql(p, max_distance)
+                for h, candidate in c.execute(sql, params):
+                    d = phash.distance(p, phash.to_unsigned(candidate))
+                    if d <= max_distance and d < distances.get(h, d + 1):
+                        distances[h] = d
+            if not distances:
+                return []
+
+            found = {}
+            hashes = list(distances)
+            # Within SQLite's limit on parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                for other, h in c.execute('SELECT DISTINCT auction_id, hash ' \
+                        'FROM auction_images WHERE auction_id != ? AND ' \
+                        'hash IN ({})'.format(', '.join('?' * len(batch))), \
+                        [auction_id] + batch):
+                    a = found.setdefault(other, {'auction_id': other, \
+                            'distance': distances[h], 'n_images': 0})
+                    a['distance'] = min(a['distance'], distances[h])
+                    a['n_images'] += 1
+
+            results = sorted(found.values(), key=lambda a: (a['distance'], \
+                    -a['n_images'], a['auction_id']))[:limit]
+            for a in results:
+                row = c.execute('SELECT title, seller FROM ebay_auctions ' \
+                        'WHERE auction_id = ?', (a['auction_id'],)).fetchone()
+                a['title'], a['seller'] = row if row is not None \
+                        else (None, None)
+            return results
+        return auctions
+
+    # Returns an iterator over the auctions matching every filter given, as
+    # dicts.  Times are unix timestamps.  Auctions end within [ended_after,
+    # ended_before), and the price and bid bounds are inclusive.  Results are
+    # streamed as they are read, ordered by order_by, one of QUERY_ORDERS, if
+    # given.
+    def query_auctions(self, seller: str = None, ended_after: int = None, \
+            ended_before: int = None, min_price: float = None, \
+            max_price: float = None, currency_code: str = None, \
+            min_bids: int = None, max_bids: int = None, order_by: str = None, \
+            limit: int = None):
+        sql, params = _query_auctions_sql(seller, ended_after, ended_before, \
+                min_price, max_price, currency_code, min_bids, max_bids, \
+                order_by, limit)
+        return self._db_iter(sql, params)
+
+    # Returns an iterator over the auctions whose title or description match
+    # query, in FTS5 query syntax, as dicts with their rank and a snippet of
+    # the text matched.  The best matches, of lowest rank, come first.
+    def search_local(self, query: str, limit: int = 20):
+        sql, params = _search_local_sql(query, limit)
+        return self._db_iter(sql, params)
+
+    # Rebuilds the full-text index of auctions from ebay_auctions, creating it
+    # if need be.  Only needed to repair it, as it is otherwise kept in step.
+    def rebuild_search_index(self):
         @self._db_transaction
         def _(c):
-            # Delete the row
-            if existing_entry is not None:
-                c.execute('DELETE FROM ebay_profiles WHERE profile_id=?', \
-                        (p['profile_id'],))
-
-            # Update the row to its new values
-            c.execute('''
-                INSERT INTO ebay_profiles (
-                    profile_id, description, contacted, location, registered,
-                    permission_given, member_since, member_since_unix,
-                    n_followers, n_reviews, percent_positive_feedback)
-                VALUES (?, ?, 0, ?, 0, 0, ?, ?, ?, ?, ?)''',
-                (p['profile_id'], p['description'], p['location'], \
-                    p['member_since'], p['member_since_unix'], \
-                    p['n_followers'], p['n_reviews'], \
-                    p['percent_positive_feedback'])
-                )
-
-    def scrape_profile_to_db(self, profile: str, base: str = 'https://www.ebay.com'):
+            if not _create_search_index(c):
+                raise ValueError('SQLite lacks FTS5')
+            _rebuild_search_index(c)
+
+    # Returns (page_id, source) for the last copy of each auction page saved,
+    # whether in the archive or, from before it, as HTML, that was fetched
+    # within [fetched_after, fetched_before) and whose ID is within [min_id,
+    # max_id].  Sources are archive records or paths.
+    def _saved_auction_pages(self, fetched_after=None, fetched_before=None, \
+            min_id=None, max_id=None):
+        def wanted(page_id, fetched):
+            try:
+                page_id = int(page_id)
+            except ValueError:
+                return False
+            return (fetched_after is None or fetched >= fetched_after) and \
+                    (fetched_before is None or fetched < fetched_before) and \
+                    (min_id is None or page_id >= min_id) and \
+                    (max_id is None or page_id <= max_id)
+
+        # Records come oldest first, so the last of each ID is kept
+        latest = {}
+        for record in self.archive.pages('auction'):
+            if wanted(record['page_id'], record['fetched']):
+                latest[record['page_id']] = (record['fetched'], record)
+        if self.auction_page_location.is_dir():
+            for path in self.auction_page_location.glob('*.html'):
+                fetched = path.stat().st_mtime
+                if wanted(path.stem, fetched) and \
+                        latest.get(path.stem, (fetched,))[0] <= fetched:
+                    latest[path.stem] = (fetched, str(path))
+        return [(page_id, source) for page_id, (_, source) in latest.items()]
+
+    # Parses the saved auction pages again, in jobs worker processes, and
+    # merges the auctions into the database as for scraping, or, if replace,
+    # overwrites their columns with the values parsed.  Pages are chosen as by
+    # _saved_auction_pages, and only those of one of formats, if given, are
+    # parsed.  Yields (page_id, page_format, auction_dict, error) as each
+    # page is parsed, where auction_dict is None if it is skipped or fails.
+    def reparse_auctions(self, formats=None, fetched_after: float = None, \
+            fetched_before: float = None, min_id: int = None, \
+            max_id: int = None, jobs: int = None, replace: bool = False):
+        if formats is not None:
+            formats = set(formats)
+            unknown = formats - set(scraper._AUCTION_PARSERS)
+            if unknown:
+                raise ValueError('Unknown auction page formats: {}' \
+                        .format(', '.join(sorted(unknown))))
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs < 1:
+            raise ValueError('jobs must be at least 1')
+        upsert_sql = _auction_replace_sql if replace else _auction_upsert_sql
+
+        pages = self._saved_auction_pages(fetched_after, fetched_before, \
+                min_id, max_id)
+        with multiprocessing.Pool(jobs, _init_reparse, (self.archive.location, \
+                self.html_parser, formats)) as pool:
+            for page_id, page_format, a, error in pool.imap_unordered( \
+                    _reparse_page, pages, _REPARSE_CHUNK_SIZE):
+                if error is not None:
+                    scraper._record_format(page_format, error)
+                    yield page_id, page_format, None, error
+                    continue
+                if a is None:
+                    yield page_id, page_format, None, None
+                    continue
+                scraper._record_format(page_format)
+
+                a = {k: v for k, v in a.items() if \
+                        k in self.ebay_auctions_entries}
+                @self._db_write_async
+                def _(c, a=a):
+                    self._upsert(c, upsert_sql(a), a)
+                yield page_id, page_format, a, None
+
+    # Queues the merge of profile into its row
+    def _merge_and_write_profile(self, profile):
+        @self._db_write_async
+        def _(c):
+            self._upsert(c, _profile_upsert_sql(profile), profile)
+
+    # Returns whether profile was last scraped within profile_ttl seconds
+    def _profile_fresh(self, profile: str, base: str):
+        _, profile_id = scraper._profile_url_and_id(profile, base)
+        row = self._db_read(lambda c: c.execute('SELECT last_scraped FROM ' \
+                'ebay_profiles WHERE profile_id = ?', (profile_id,)).fetchone())
+        return row is not None and row[0] is not None and \
+                time.time() - row[0] < self.profile_ttl
+
+    # Scrapes profile into the database, unless it was scraped within
+    # profile_ttl seconds and not force.  Returns whether it was scraped.
+    def scrape_profile_to_db(self, profile: str, base: str = 'https://www.ebay.com', \
+            force: bool = False):
+        if not force and self._profile_fresh(profile, base):
+            return False
         profile_dict = scraper.scrape_profile_page(profile, base, \
-                page_save_path=self.profile_page_location)
+                archive=self.archive, \
+                transport=self.transport, html_parser=self.html_parser)
+        profile_dict['last_scraped'] = int(time.time())
         self._merge_and_write_profile(profile_dict)
+        return True
 
-    # Some ebay search and download method
-    def scrape_search_to_db(self, query_strings, n_results, base: str = 'https://www.ebay.com'):
-        results = {}
-        for query_string in query_strings:
-            results = {**results, \
-                    **scraper.scrape_search_page(query_string, n_results, base)}
+    # Scrapes the results of each search, along with their sellers' profiles.
+    # This runs as a pipeline: auctions are scraped as soon as their search
+    # page is parsed, and each new seller is queued for scraping as soon as an
+    # auction of theirs is written.  Each stage runs up to concurrency workers.
+    #
+    # If job_id is given, the progress of each search, auction and profile is
+    # recorded against that crawl job.  Those the job has already done are
+    # skipped, and those it has still to do, by max_attempts, are done first.
+    # Sellers' profiles scraped within profile_ttl are only fetched again if
+    # force_profiles.
+    def scrape_search_to_db(self, query_strings, n_results, \
+            base: str = 'https://www.ebay.com', concurrency: int = 1, \
+            job_id: int = None, max_attempts: int = 3, \
+            force_profiles: bool = False):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+
+        scraped_auctions = set()
         scraped_profiles = set()
-        for auction_id, d in results.items():
+        done_auctions = set()
+        profiles_lock = threading.Lock()
+        if job_id is not None:
+            self._add_crawl_items(job_id, 'search', query_strings)
+            done_auctions.update(self._crawl_items(job_id, 'auction'))
+            scraped_profiles.update(self._crawl_items(job_id, 'profile'))
+
+        def scrape_profile(profile):
             try:
-                print('Scraping auction url {}'.format(d['url']))
-                a = self.scrape_auction_to_db(d['url'])
+                print('Scraping profile {}'.format(profile))
+                if not self._crawl(job_id, 'profile', profile, \
+                        lambda: self.scrape_profile_to_db(profile, base, \
+                        force_profiles)):
+                    print('Profile {} is fresh'.format(profile))
+            except Exception:
+                print(colored('Error processing profile {}'.format(profile), 'red'))
+                print(colored(traceback.format_exc(), 'red'))
+
+        def submit_profile(profile):
+            if job_id is not None:
+                self._add_crawl_items(job_id, 'profile', [profile])
+            profile_executor.submit(scrape_profile, profile)
+
+        def scrape_auction(url):
+            try:
+                print('Scraping auction url {}'.format(url))
+                a = self._crawl(job_id, 'auction', url, \
+                        lambda: self.scrape_auction_to_db(url))
                 profile = a['seller']
-                if profile not in scraped_profiles:
-                    print('Scraping profile {}'.format(a['seller']))
-                    self.scrape_profile_to_db(a['seller'])
-                    scraped_profiles.add(profile)
-                else:
-                    print('Already scraped profile {}'.format(a['seller']))
             except Exception:
-                print(colored('Error processing auction {}'.format(d['url']), 'red'))
+                print(colored('Error processing auction {}'.format(url), 'red'))
                 print(colored(traceback.format_exc(), 'red'))
+                return
+
+            # Queue each seller only once across all workers
+            with profiles_lock:
+                is_new = profile not in scraped_profiles
+                scraped_profiles.add(profile)
+            if is_new:
+                submit_profile(profile)
+            else:
+                print('Already scraped profile {}'.format(profile))
+
+        def submit_auction(url):
+            if url in done_auctions:
+                print('Already scraped auction url {}'.format(url))
+                return
+            if job_id is not None:
+                self._add_crawl_items(job_id, 'auction', [url])
+            auction_executor.submit(scrape_auction, url)
+
+        def search(query_string):
+            for res in scraper.iter_search_page(query_string, n_results, \
+                    base, transport=self.transport, \
+                    html_parser=self.html_parser):
+                for auction_id, d in res.items():
+                    if auction_id in scraped_auctions:
+                        continue
+                    scraped_auctions.add(auction_id)
+                    submit_auction(d['url'])
+
+        # The auction stage is shut down first, as it feeds the profile stage
+        with ThreadPoolExecutor(max_workers=concurrency) as profile_executor:
+            with ThreadPoolExecutor(max_workers=concurrency) as auction_executor:
+                # Finish what the job left undone
+                if job_id is not None:
+                    for profile in self._crawl_items(job_id, 'profile', \
+                            max_attempts):
+                        scraped_profiles.add(profile)
+                        submit_profile(profile)
+                    for url in self._crawl_items(job_id, 'auction', \
+                            max_attempts):
+                        submit_auction(url)
+
+                for query_string in query_strings:
+                    self._crawl(job_id, 'search', query_string, \
+                            lambda: search(query_string))
+
+    # Continues the crawl job job_id where it was stopped, doing each of its
+    # items not yet done, and retrying those that failed fewer than
+    # max_attempts times.  Returns what scrape_auctions_to_db or
+    # scrape_search_to_db, as run by the job, return.
+    def resume_crawl_job(self, job_id: int, concurrency: int = 1, \
+            max_attempts: int = 3):
+        job = self.crawl_job(job_id)
+        args = job['args']
+        if job['kind'] == 'auction':
+            return self.scrape_auctions_to_db(self._crawl_items(job_id, \
+                    'auction', max_attempts), args['base'], concurrency, \
+                    job_id)
+        return self.scrape_search_to_db(self._crawl_items(job_id, 'search', \
+                max_attempts), args['n_results'], args['base'], concurrency, \
+                job_id, max_attempts, args.get('force_profiles', False))
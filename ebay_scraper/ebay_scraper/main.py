@@ -4,64 +4,341 @@ import sys
 import traceback
 import pathlib
 import typing
+import csv
+import time
+import datetime
+import dateutil.parser
 
 from . import db_interface
+from . import scraper
+from .cache import ResponseCache
+from .transport import Transport
 
 app = typer.Typer()
 state = {'db_path': None, 'base_url': None, 'image_location': None, 
-        'verbose': None, 'data_location': None}
+        'verbose': None, 'data_location': None, 'pool_size': None, \
+        'timeout': None, 'image_concurrency': None, 'cache': None, \
+        'cache_ttl': None, 'cache_size': None, 'html_parser': None, \
+        'batch_size': None, 'flush_interval': None, \
+        'archive_compression': None, 'rate_limits': None, \
+        'default_rate': None, 'max_retries': None, 'profile_ttl': None}
+
+def print_error(e):
+    if state['verbose']:
+        print(colored(''.join(traceback.format_exception( \
+                type(e), e, e.__traceback__)), 'red'))
+    else:
+        print(colored(e, 'red'))
 
 def setup():
     try:
-        e = db_interface.EbayScraper(state['db_path'], state['data_location'])
+        cache = None
+        if state['cache']:
+            cache = ResponseCache(pathlib.Path(state['data_location']) \
+                    .joinpath('ebay', 'cache'), state['cache_ttl'], \
+                    state['cache_size'] * 1024**2)
+        transport = Transport(pool_maxsize=state['pool_size'], \
+                timeout=state['timeout'], cache=cache, \
+                rate_limits=state['rate_limits'], \
+                default_rate=state['default_rate'], \
+                max_retries=state['max_retries'])
+        e = db_interface.EbayScraper(state['db_path'], state['data_location'], \
+                transport, image_concurrency=state['image_concurrency'], \
+                html_parser=state['html_parser'], \
+                batch_size=state['batch_size'], \
+                flush_interval=state['flush_interval'], \
+                archive_compression=state['archive_compression'], \
+                profile_ttl=state['profile_ttl'])
     except Exception as e:
         # Print the setup exception cleanly and exit
         print(e)
         sys.exit(1)
     return e
 
+def teardown(e):
+    if state['verbose']:
+        for host, s in e.transport.stats().items():
+            print('{}: {} requests over {} connections, {} throttled, ' \
+                    '{} retried, {:.1f}s waiting (at most {:.1f}s)'.format( \
+                    host, s['requests'], s['connections'], s['throttled'], \
+                    s['retries'], s['wait'], s['max_wait']))
+        if e.transport.cache is not None:
+            s = e.transport.cache.stats()
+            print('Cache: {} hits, {} misses, {} revalidations, {} bytes saved' \
+                    .format(s['hits'], s['misses'], s['revalidations'], \
+                    s['bytes_saved']))
+        for page_format, s in scraper.auction_format_stats().items():
+            if s['parsed'] or s['failed']:
+                print('{} auction pages: {} parsed, {} failed' \
+                        .format(page_format or 'Unrecognised', s['parsed'], \
+                        s['failed']))
+    e.close()
+    e.transport.close()
+
 @app.callback()
 def main(db_path: str, data_location: str, verbose: bool = False, \
-        base_url: str = 'https://www.ebay.com'):
+        base_url: str = 'https://www.ebay.com', pool_size: int = 10, \
+        timeout: float = 30, image_concurrency: int = 4, cache: bool = False, \
+        cache_ttl: float = 3600, cache_size: int = 1024, \
+        html_parser: str = 'html.parser', batch_size: int = 64, \
+        flush_interval: float = 0.5, archive_compression: str = 'gzip', \
+        rate_limit: typing.Optional[typing.List[str]] = None, \
+        default_rate: typing.Optional[float] = None, max_retries: int = 4, \
+        profile_ttl: float = 86400):
     state['db_path'] = db_path
     state['verbose'] = verbose
     state['base_url'] = base_url
     state['data_location'] = data_location
+    state['pool_size'] = pool_size
+    state['timeout'] = timeout
+    state['image_concurrency'] = image_concurrency
+    state['cache'] = cache
+    state['cache_ttl'] = cache_ttl
+    state['cache_size'] = cache_size
+    state['html_parser'] = html_parser
+    state['batch_size'] = batch_size
+    state['flush_interval'] = flush_interval
+    state['archive_compression'] = archive_compression
+    state['default_rate'] = default_rate
+    state['max_retries'] = max_retries
+    state['profile_ttl'] = profile_ttl
+
+    # Rate limits are given as PATTERN=RATE, such as www.ebay.*=2
+    state['rate_limits'] = {}
+    for limit in rate_limit or []:
+        pattern, _, rate = limit.rpartition('=')
+        try:
+            state['rate_limits'][pattern] = float(rate)
+        except ValueError:
+            raise typer.BadParameter('Rate limits must be given as ' \
+                    'PATTERN=RATE, not {}'.format(limit))
 
 @app.command()
-def auction(auction: typing.List[str]):
+def auction(auction: typing.List[str], concurrency: int = 1):
     e = setup()
-    for a in auction:
-        try:
-            e.scrape_auction_to_db(a, state['base_url'])
-        except Exception as e:
-            if state['verbose']:
-                print(colored(traceback.format_exc(), 'red'))
+    job_id = e.create_crawl_job('auction', {'base': state['base_url']})
+    print('Crawl job {}'.format(job_id))
+    for _, _, exception in e.scrape_auctions_to_db(auction, state['base_url'], \
+            concurrency, job_id):
+        if exception is not None:
+            print_error(exception)
+    teardown(e)
+
+@app.command()
+def refresh(concurrency: int = 1, min_interval: float = 300, \
+        max_interval: float = 86400, \
+        duration: typing.Optional[float] = None):
+    e = setup()
+    counts = {'refreshed': 0, 'failed': 0}
+    until = time.time() + duration if duration is not None else None
+    try:
+        for auction_id, _, exception in e.refresh_auctions( \
+                state['base_url'], concurrency, min_interval, max_interval, \
+                until):
+            if exception is not None:
+                counts['failed'] += 1
+                print_error(exception)
             else:
-                print(colored(e, 'red'))
+                counts['refreshed'] += 1
+                print('Refreshed auction {}'.format(auction_id))
+    except Exception as exception:
+        print_error(exception)
+    print('{} auctions refreshed, {} failed'.format(counts['refreshed'], \
+            counts['failed']))
+    teardown(e)
 
 @app.command()
-def profile(profile: typing.List[str]):
+def profile(profile: typing.List[str], force: bool = False):
     e = setup()
     for p in profile:
         try:
-            e.scrape_profile_to_db(p, state['base_url'])
-        except Exception as e:
-            if state['verbose']:
-                print(colored(traceback.format_exc(), 'red'))
+            if not e.scrape_profile_to_db(p, state['base_url'], force):
+                print('Profile {} is fresh, skipping'.format(p))
+        except Exception as exception:
+            print_error(exception)
+    teardown(e)
+
+@app.command()
+def search(n_results: int, query_string: typing.List[str], \
+        concurrency: int = 1, force: bool = False):
+    e = setup()
+    job_id = e.create_crawl_job('search', {'base': state['base_url'], \
+            'n_results': n_results, 'force_profiles': force})
+    print('Crawl job {}'.format(job_id))
+    try:
+        e.scrape_search_to_db(query_string, n_results, state['base_url'], \
+                concurrency, job_id, force_profiles=force)
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+@app.command()
+def resume(job_id: int, concurrency: int = 1, max_attempts: int = 3):
+    e = setup()
+    try:
+        results = e.resume_crawl_job(job_id, concurrency, max_attempts)
+        # Auction jobs yield their results as they complete
+        for _, _, exception in results or []:
+            if exception is not None:
+                print_error(exception)
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+@app.command()
+def jobs():
+    e = setup()
+    try:
+        for job_id in e.crawl_jobs():
+            job = e.crawl_job(job_id)
+            print('{} {} {} {}'.format(job['job_id'], job['kind'], \
+                    datetime.datetime.fromtimestamp(job['created']) \
+                    .isoformat(' ', 'seconds'), ', '.join('{} {}'.format( \
+                    n, status) for status, n in job['items'].items())))
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+# Returns the unix timestamp of s, given either as one or as a date
+def _parse_time(s):
+    if s is None:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        return int(dateutil.parser.parse(s).timestamp())
+
+@app.command()
+def query(seller: typing.Optional[str] = None, \
+        ended_after: typing.Optional[str] = None, \
+        ended_before: typing.Optional[str] = None, \
+        min_price: typing.Optional[float] = None, \
+        max_price: typing.Optional[float] = None, \
+        currency_code: typing.Optional[str] = None, \
+        min_bids: typing.Optional[int] = None, \
+        max_bids: typing.Optional[int] = None, \
+        order_by: typing.Optional[str] = None, \
+        limit: typing.Optional[int] = None):
+    e = setup()
+    try:
+        # Rows are written as they are read
+        writer = csv.DictWriter(sys.stdout, fieldnames=e.ebay_auctions_entries)
+        writer.writeheader()
+        for a in e.query_auctions(seller, _parse_time(ended_after), \
+                _parse_time(ended_before), min_price, max_price, \
+                currency_code, min_bids, max_bids, order_by, limit):
+            writer.writerow(a)
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+@app.command()
+def search_local(query_string: typing.List[str], limit: int = 20):
+    e = setup()
+    try:
+        for a in e.search_local(' '.join(query_string), limit):
+            print(colored('{} {}'.format(a['auction_id'], a['title']), 'green'))
+            print('    ' + ' '.join(a['snippet'].split()))
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+@app.command()
+def rebuild_search_index():
+    e = setup()
+    try:
+        e.rebuild_search_index()
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+@app.command()
+def index_images(jobs: typing.Optional[int] = None):
+    e = setup()
+    counts = {'indexed': 0, 'failed': 0}
+    try:
+        for path, error in e.index_images(jobs):
+            if error is not None:
+                counts['failed'] += 1
+                print(colored('Could not hash image {}: {}'.format(path, \
+                        error), 'red'))
             else:
-                print(colored(e, 'red'))
+                counts['indexed'] += 1
+        e.flush()
+    except Exception as exception:
+        print_error(exception)
+    print('{} images indexed, {} failed'.format(counts['indexed'], \
+            counts['failed']))
+    teardown(e)
 
 @app.command()
-def search(n_results: int, query_string: typing.List[str]):
+def duplicates(auction_id: int, max_distance: int = 6, \
+        limit: typing.Optional[int] = None):
     e = setup()
     try:
-        e.scrape_search_to_db(query_string, n_results, state['base_url'])
-    except Exception as e:
-        if state['verbose']:
-            print(colored(traceback.format_exc(), 'red'))
-        else:
-            print(colored(e, 'red'))
+        for a in e.find_duplicate_auctions(auction_id, max_distance, limit):
+            print(colored('{} {}'.format(a['auction_id'], a['title']), 'green'))
+            print('    seller {}, {} images within {} bits'.format( \
+                    a['seller'], a['n_images'], a['distance']))
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
+
+@app.command()
+def reparse(page_format: typing.Optional[typing.List[str]] = \
+        typer.Option(None, '--format'), \
+        fetched_after: typing.Optional[str] = None, \
+        fetched_before: typing.Optional[str] = None, \
+        min_id: typing.Optional[int] = None, \
+        max_id: typing.Optional[int] = None, \
+        jobs: typing.Optional[int] = None, replace: bool = False, \
+        report_interval: float = 10):
+    e = setup()
+    counts = {'parsed': 0, 'skipped': 0, 'failed': 0}
+    start = time.monotonic()
+    last_report = start
+    try:
+        for page_id, _, a, error in e.reparse_auctions(page_format or None, \
+                _parse_time(fetched_after), _parse_time(fetched_before), \
+                min_id, max_id, jobs, replace):
+            if error is not None:
+                counts['failed'] += 1
+                print(colored('Could not parse auction {}: {}'.format( \
+                        page_id, error), 'red'))
+            elif a is None:
+                counts['skipped'] += 1
+            else:
+                counts['parsed'] += 1
+
+            now = time.monotonic()
+            if now - last_report >= report_interval:
+                last_report = now
+                n = sum(counts.values())
+                print('{} pages in {:.0f}s, {:.1f} pages/s'.format(n, \
+                        now - start, n / (now - start)))
+        e.flush()
+    except Exception as exception:
+        print_error(exception)
+    elapsed = time.monotonic() - start
+    n = sum(counts.values())
+    print('{} pages in {:.1f}s, {:.1f} pages/s: {} parsed, {} skipped, ' \
+            '{} failed'.format(n, elapsed, n / elapsed if elapsed else 0, \
+            counts['parsed'], counts['skipped'], counts['failed']))
+    teardown(e)
+
+@app.command()
+def archived_page(kind: str, page_id: str, \
+        fetched: typing.Optional[float] = None):
+    e = setup()
+    try:
+        data = e.archive.get(kind, page_id, fetched)
+        if data is None:
+            raise ValueError('No {} page {} is archived'.format(kind, page_id))
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+    except Exception as exception:
+        print_error(exception)
+    teardown(e)
 
 def main():
     app()
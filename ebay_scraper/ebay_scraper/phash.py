@@ -0,0 +1,60 @@
+import itertools
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Perceptual hashes are 64-bit dHashes, indexed as CHUNKS chunks of
+# CHUNK_BITS bits each.  Two hashes within a Hamming distance d of each other
+# have at least one chunk within d // CHUNKS of each other, so neighbours are
+# found by looking up the few chunks near each of a hash's.
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+MAX_DISTANCE = 4 * CHUNKS - 1
+
+# Returns the 64-bit difference hash of the image at path: whether each pixel
+# of the image, shrunk to 9x8 in grey, is brighter than the one to its right.
+# Resized, recompressed or lightly edited copies of an image hash the same or
+# within a few bits.
+def dhash(path):
+    if Image is None:
+        raise ValueError('Perceptual hashing requires Pillow to be installed')
+    with Image.open(path) as im:
+        # JPEGs are decoded straight to a fraction of their size
+        im.draft('L', (9 * 8, 8 * 8))
+        pixels = list(im.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            h = h << 1 | (pixels[i] > pixels[i + 1])
+    return h
+
+# SQLite integers are signed, so hashes are stored as such
+def to_signed(h):
+    return h - (1 << HASH_BITS) if h >= 1 << (HASH_BITS - 1) else h
+
+def to_unsigned(h):
+    return h & ((1 << HASH_BITS) - 1)
+
+def distance(h1, h2):
+    return bin(h1 ^ h2).count('1')
+
+# Returns the chunks of h, most significant first
+def chunks(h):
+    mask = (1 << CHUNK_BITS) - 1
+    return [(h >> (CHUNK_BITS * (CHUNKS - 1 - i))) & mask \
+            for i in range(CHUNKS)]
+
+# Returns every chunk within radius bits of chunk
+def chunk_neighbours(chunk, radius):
+    neighbours = []
+    for r in range(radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), r):
+            neighbour = chunk
+            for bit in bits:
+                neighbour ^= 1 << bit
+            neighbours.append(neighbour)
+    return neighbours
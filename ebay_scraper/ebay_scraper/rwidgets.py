@@ -0,0 +1,214 @@
+import bisect
+import re
+
+# A fast extractor for the key/value pairs passed to $rwidgets(...) calls in
+# eBay's auction page javascript.
+#
+# It reproduces what walking slimit's AST for each $rwidgets call yields: for
+# each call, in source order, every object property as a (key, value) pair.
+# Keys and values are the raw source text of the property name and value,
+# stripped of double quotes, and values that are not a single literal or
+# identifier, or a unary operation on one, are ''.
+#
+# Only the subset of javascript that eBay passes to $rwidgets is understood:
+# literals, identifiers, arrays, objects, calls and operators.  Anything for
+# which the result could differ from slimit's raises UnsupportedScript, and the
+# caller should fall back to slimit.
+
+class UnsupportedScript(Exception):
+    pass
+
+# Matches the next token, after any whitespace and comments.  Characters that
+# start no token are matched alone, and the end of the script as ''.
+_TOKEN = re.compile(r'''
+    (?:\s+|//[^\n]*|/\*.*?\*/)*
+    (   [{}()\[\],:;?~]
+      | "[^"\\\n]*(?:\\.[^"\\\n]*)*"|'[^'\\\n]*(?:\\.[^'\\\n]*)*'
+      | [^\W\d][\w$]*|\$[\w$]*
+      | 0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?
+      | >>>=|===|!==|>>>|<<=|>>=|=>|\.\.\.|&&|\|\||\+\+|--
+      | [-+*/%&|^<>=!]=|<<|>>|[-+*/%&|^<>=!.]
+      | .
+      | \Z
+    )
+''', re.S | re.X)
+
+# Characters that start punctuation, or are tokens in their own right
+_PUNCTUATION = set('{}()[],:.;?~-+*/%&|^<>=!')
+_SINGLE_CHARACTER_TOKENS = _PUNCTUATION | {'$', '_'}
+
+_REGEX = re.compile(r'/(?:[^/\\\n\[]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*')
+
+# Tokens after which a / is a division rather than the start of a regex
+_DIVISION_PRECEDERS = {')', ']', '}'}
+# Names after which a / is the start of a regex rather than a division
+_REGEX_PRECEDERS = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', \
+        'delete', 'void', 'throw', 'case', 'do', 'else'}
+
+# Tokens within a $rwidgets call whose meaning this extractor cannot follow.
+# Without these, a : within a call can only separate an object property name
+# from its value.
+_UNSUPPORTED = {'function', 'class', '=>', '?', ';', '...', '++', '--', '=', \
+        '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '>>>=', '&=', '|=', '^=', \
+        'get', 'set'}
+
+# Tokens which, starting a property value, make it a unary operation
+_UNARY = {'-', '+', '!', '~', 'typeof', 'void', 'delete'}
+_UNARY_WORDS = {'typeof', 'void', 'delete'}
+
+# Matches a property within NUL-separated tokens, capturing its name and the
+# first three tokens of its value and what follows it
+_PROPERTY = re.compile(r'(?<![^\0])[{,]\0([^\0]+)\0:' \
+        r'(?=\0([^\0]+)\0([^\0]+)(?:\0([^\0]+))?)')
+
+_BRACKETS = {'(', '[', '{', ')', ']', '}'}
+_CLOSING = {')': '(', ']': '[', '}': '{'}
+_VALUE_END = {',', '}'}
+# Values which are not literals or identifiers, despite their first character
+_NON_VALUES = {'this', 'new', 'function'}
+
+# Returns the kind of a token: 'string', 'number', 'name', 'regex' or 'punct'
+def _kind(token):
+    c = token[0]
+    if c == '"' or c == "'":
+        return 'string'
+    if c.isdigit() or (c == '.' and len(token) > 1 and token[1].isdigit()):
+        return 'number'
+    if c == '$' or c == '_' or c.isalpha():
+        return 'name'
+    if c == '/' and token != '/' and token != '/=':
+        return 'regex'
+    return 'punct'
+
+def _regex_allowed(prev):
+    if prev is None:
+        return True
+    kind = _kind(prev)
+    if kind == 'punct':
+        return prev not in _DIVISION_PRECEDERS
+    return kind == 'name' and prev in _REGEX_PRECEDERS
+
+def _check_characters(tokens):
+    for token in tokens:
+        if len(token) == 1 and token not in _SINGLE_CHARACTER_TOKENS \
+                and not token.isalnum():
+            raise UnsupportedScript('Unexpected character {!r}'.format(token))
+
+# Tokenizes text, one match at a time, resolving each / as a division or regex
+def _tokenize_exact(text):
+    tokens = []
+    append = tokens.append
+    pos = 0
+    while True:
+        restart = None
+        for m in _TOKEN.finditer(text, pos):
+            token = m.group(1)
+            if token == '':
+                break
+            if (token == '/' or token == '/=') \
+                    and _regex_allowed(tokens[-1] if tokens else None):
+                regex = _REGEX.match(text, m.start(1))
+                if regex is None:
+                    raise UnsupportedScript('Unterminated regex at {}' \
+                            .format(m.start(1)))
+                append(regex.group())
+                restart = regex.end()
+                break
+            append(token)
+        if restart is None:
+            _check_characters(tokens)
+            return tokens
+        pos = restart
+
+# Tokenizes text in one pass, which is only correct if it holds no regexes.
+# Falls back to _tokenize_exact if it may.
+def _tokenize(text):
+    tokens = _TOKEN.findall(text)
+    tokens.pop()
+
+    if '/' in tokens or '/=' in tokens:
+        for i, token in enumerate(tokens):
+            if (token == '/' or token == '/=') \
+                    and _regex_allowed(tokens[i-1] if i > 0 else None):
+                return _tokenize_exact(text)
+    _check_characters(set(tokens))
+    return tokens
+
+# Returns the index of the parenthesis closing that at tokens[i]
+def _find_closing(tokens, brackets, i):
+    stack = []
+    for j in brackets[bisect.bisect_left(brackets, i):]:
+        token = tokens[j]
+        if token in _CLOSING:
+            if not stack or stack.pop() != _CLOSING[token]:
+                raise UnsupportedScript('Unbalanced {}'.format(token))
+            if not stack:
+                return j
+        else:
+            stack.append(token)
+    raise UnsupportedScript('Unterminated $rwidgets call')
+
+# Returns the properties of the call spanning tokens[start:end+1]
+def _extract_call(tokens, start, end):
+    span = tokens[start:end+1]
+    unsupported = _UNSUPPORTED.intersection(span)
+    if unsupported - {'get', 'set'}:
+        raise UnsupportedScript('Unsupported tokens {}'.format(unsupported))
+    if unsupported:
+        # get and set are only supported as property names
+        for i, token in enumerate(span):
+            if (token == 'get' or token == 'set') and span[i+1] != ':':
+                raise UnsupportedScript('Property accessors are not supported')
+
+    # Join the tokens with NULs, so that each property can be found with one
+    # regex match: an opening brace or comma, a name, a colon, and the first
+    # token of its value and the token after that
+    matches = _PROPERTY.findall('\0'.join(span))
+    if len(matches) != span.count(':'):
+        raise UnsupportedScript('Unexpected :')
+
+    properties = []
+    for key, value, after, then in matches:
+        if key[0] in _PUNCTUATION and _kind(key) == 'punct':
+            raise UnsupportedScript('Unexpected property name {}'.format(key))
+        if value in _UNARY:
+            # slimit yields a unary operation as its source, so only one on a
+            # lone literal or identifier can be reproduced
+            if then not in _VALUE_END or after in _NON_VALUES \
+                    or (after[0] in _PUNCTUATION and _kind(after) == 'punct'):
+                raise UnsupportedScript('Unsupported unary property value')
+            if value in _UNARY_WORDS:
+                value += ' '
+            properties.append((key.strip('"'), (value + after).strip('"')))
+            continue
+        if after not in _VALUE_END or value in _NON_VALUES \
+                or (value[0] in _PUNCTUATION and _kind(value) == 'punct'):
+            # The value is not a lone literal or identifier
+            value = ''
+        properties.append((key.strip('"'), value.strip('"')))
+    return properties
+
+# Returns a list holding, for each $rwidgets call in script_text in source
+# order, the list of (key, value) properties within it
+def extract_rwidgets(script_text):
+    if '`' in script_text:
+        raise UnsupportedScript('Template literals are not supported')
+    if '\0' in script_text:
+        raise UnsupportedScript('NUL characters are not supported')
+    tokens = _tokenize(script_text)
+
+    calls = []
+    brackets = None
+    i = -1
+    while True:
+        try:
+            i = tokens.index('$rwidgets', i + 1)
+        except ValueError:
+            return calls
+        if i + 1 < len(tokens) and tokens[i+1] == '(' \
+                and (i == 0 or tokens[i-1] not in ('.', 'new')):
+            if brackets is None:
+                brackets = [j for j, token in enumerate(tokens) \
+                        if token in _BRACKETS]
+            end = _find_closing(tokens, brackets, i + 1)
+            calls.append(_extract_call(tokens, i + 1, end))
@@ -1,4 +1,3 @@
-import requests
 from bs4 import BeautifulSoup
 from slimit.parser import Parser
 from slimit.visitors import nodevisitor
@@ -13,9 +12,39 @@ import dateutil.parser
 
 import sys
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from pprint import pprint
 from typing import List
 
+from . import rwidgets
+from .transport import get_default_transport
+
+# slimit is not thread-safe, and the stdout/stderr bodge below swaps global
+# streams, so only one thread may parse javascript at a time.  The null stream
+# is never closed, as other threads may still hold it while it is swapped in.
+_slimit_lock = threading.Lock()
+_devnull = open(os.devnull, 'w')
+
+# The HTML parser backends pages may be parsed with, as BeautifulSoup features.
+# html.parser is pure python; lxml is much faster, but must be installed.
+HTML_PARSERS = ['html.parser', 'lxml']
+
+def _make_soup(text, html_parser: str = 'html.parser'):
+    if html_parser not in HTML_PARSERS:
+        raise ValueError('html_parser must be one of {}'.format(HTML_PARSERS))
+    soup = BeautifulSoup(text, html_parser)
+    if html_parser != 'html.parser':
+        # lxml keeps the contents of an iframe as raw text, where html.parser
+        # parses them as markup.  Parse them, so every backend gives one tree.
+        for iframe in soup.find_all('iframe'):
+            if iframe.string is not None and '<' in iframe.string:
+                fragment = BeautifulSoup(iframe.string, 'html.parser')
+                iframe.clear()
+                iframe.append(fragment)
+    return soup
+
 def _get_dict_value(d, k):
     try:
         d[k]
@@ -51,27 +80,102 @@ def _normalise_description(desc):
     norm = strip_multiple(norm, ' ')
     return norm
 
-def _get_page_resolve_iframes(url):
-    r = requests.get(url)
+# Iframes that the auction parsers read; all others (adverts, tracking) are
+# never fetched.  An iframe is allowed if it sits within a div of one of these
+# ids, or if its source is served from one of these domains.
+_IFRAME_ALLOWED_PARENT_IDS = ['desc_div']
+_IFRAME_ALLOWED_DOMAINS = ['ebaydesc.com']
+
+# Seconds allowed to resolve all the iframes of a page
+_IFRAME_DEADLINE = 10
+
+def _iframe_allowed(iframe, src):
+    for parent_id in _IFRAME_ALLOWED_PARENT_IDS:
+        if iframe.find_parent('div', id=parent_id) is not None:
+            return True
+    host = urlparse(src).hostname or ''
+    return any(host == d or host.endswith('.' + d) \
+            for d in _IFRAME_ALLOWED_DOMAINS)
+
+def _get_iframe_soup(src, transport, html_parser, responses=None):
+    r = transport.get(src, cached=True)
     if not r.ok:
-        raise ValueError('The requested page could not be found')
-    soup = BeautifulSoup(r.text, 'html.parser')
+        return None
+    if responses is not None:
+        responses[src] = r
+    return _make_soup(r.text, html_parser)
+
+# Returns (iframe, src) for each iframe of soup, the page at url, that is
+# allowed to be resolved
+def _allowed_iframes(soup, url):
+    iframes = []
     for iframe in soup.find_all('iframe'):
         try:
-            src = iframe['src']
+            src = urljoin(url, iframe['src'])
         except KeyError:
             continue
+        if _iframe_allowed(iframe, src):
+            iframes.append((iframe, src))
+    return iframes
+
+# Returns the soup of the page at url, with the soups of its allowed iframes
+# appended to them.  If responses is given, the responses of the page and of
+# each iframe resolved are added to it by URL.
+def _get_page_resolve_iframes(url, transport=None, \
+        iframe_deadline: float = _IFRAME_DEADLINE, \
+        html_parser: str = 'html.parser', responses=None):
+    transport = transport or get_default_transport()
+    r = transport.get(url, cached=True)
+    if not r.ok:
+        raise ValueError('The requested page could not be found')
+    if responses is not None:
+        responses[url] = r
+    soup = _make_soup(r.text, html_parser)
 
-        ir = requests.get(src)
-        if not ir.ok:
+    iframes = _allowed_iframes(soup, url)
+    if not iframes:
+        return soup
+
+    # Fetch the iframes concurrently.  Those not resolved by the deadline are
+    # left empty, as are those that fail.
+    executor = ThreadPoolExecutor(max_workers=len(iframes))
+    try:
+        futures = {executor.submit(_get_iframe_soup, src, transport, \
+                html_parser, responses): iframe for iframe, src in iframes}
+        done, _ = wait(futures, timeout=iframe_deadline)
+    finally:
+        executor.shutdown(wait=False)
+
+    for future in done:
+        try:
+            iframe_soup = future.result()
+        except Exception:
             continue
-        iframe_soup = BeautifulSoup(ir.text, 'html.parser')
-        iframe.append(iframe_soup)
+        if iframe_soup is not None:
+            futures[future].append(iframe_soup)
+    return soup
+
+# auction can be a URL or a page ID.  If archive, an archive.PageArchive, is
+# given, the raw page and its iframes are stored in it.
+# Returns the soup of the archived page of record, with the soups of its
+# allowed iframes appended to them from the archive, as when it was fetched.
+# Iframes are taken from the same fetch, or else the last.
+def _archived_page_soup(archive, record, html_parser: str = 'html.parser'):
+    def decode(record):
+        return archive.read(record['hash']).decode(record['encoding'] \
+                or 'utf-8', errors='ignore')
+
+    soup = _make_soup(decode(record), html_parser)
+    for iframe, src in _allowed_iframes(soup, record['url'] or ''):
+        iframe_record = archive.lookup('iframe', src, record['fetched']) \
+                or archive.lookup('iframe', src)
+        if iframe_record is not None:
+            iframe.append(_make_soup(decode(iframe_record), html_parser))
     return soup
 
-# auction can be a URL or a page ID
 def scrape_auction_page(auction, base: str = 'https://www.ebay.com', \
-        raw: bool = False, page_save_path=None):
+        raw: bool = False, page_save_path=None, transport=None, \
+        html_parser: str = 'html.parser', archive=None):
     is_file = False
     try:
         auction_id = int(auction)
@@ -89,13 +193,15 @@ def scrape_auction_page(auction, base: str = 'https://www.ebay.com', \
     else:
         url = _generate_auction_url(auction_id, base)
 
+    responses = {} if archive is not None else None
     if is_file:
-        with open(url, errors='ignore') as f:
-            page = f.read()
-            soup = BeautifulSoup(page, 'html.parser')
+        with open(url, 'rb') as f:
+            data = f.read()
+        soup = _make_soup(data.decode(errors='ignore'), html_parser)
     else:
         # Open page, resolving iframes
-        soup = _get_page_resolve_iframes(url)
+        soup = _get_page_resolve_iframes(url, transport, \
+                html_parser=html_parser, responses=responses)
 
     a = _parse_auction_page(soup, ['maxImageUrl', 'displayImgUrl'])
 
@@ -104,6 +210,17 @@ def scrape_auction_page(auction, base: str = 'https://www.ebay.com', \
         name = '{}.html'.format(a['auction_id'])
         with open(page_save_path.joinpath(name), 'w') as f:
             f.write(soup.prettify())
+    if archive is not None:
+        fetched = time.time()
+        if is_file:
+            archive.put('auction', a['auction_id'], data, auction, \
+                    fetched=fetched)
+        for src, r in responses.items():
+            if src == url:
+                archive.put('auction', a['auction_id'], r.content, url, \
+                        r.encoding, fetched)
+            else:
+                archive.put('iframe', src, r.content, src, r.encoding, fetched)
 
     return a
 
@@ -158,13 +275,88 @@ def _parse_2010_auction_soup(soup, duplicates, raw):
 #            'domain': _get_dict_value(raw_data, 'currentDomain')
     return results
 
-def _parse_2020_auction_soup(soup, duplicates, raw=False):
+# Returns a list holding, for each $rwidgets call in script_text in the order
+# visited, the list of (key, value) assignments within it
+def _extract_rwidgets_slimit(script_text):
     # Strip c from s, without exception
     def strip(s, c):
         if isinstance(s, str):
             return s.strip(c)
         return s
 
+    calls = []
+    with _slimit_lock:
+        # Bodge: until we move from slimit to calmjs
+        sys.stdout = _devnull
+        sys.stderr = _devnull
+        try:
+            parser = Parser()
+            tree = parser.parse(script_text)
+            for node in nodevisitor.visit(tree):
+                if isinstance(node, ast.FunctionCall):
+                    if isinstance(node.identifier, ast.Identifier):
+                        if node.identifier.value == '$rwidgets':
+                            # Deal with here
+                            assignments = []
+                            for n in nodevisitor.visit(node):
+                                if isinstance(n, ast.Assign):
+                                    k = getattr(n.left, 'value', '').strip('"')
+                                    if isinstance(n.right, ast.UnaryOp):
+                                        # Rather than its operand node
+                                        v = n.right.to_ecma().strip('"')
+                                    else:
+                                        v = strip(getattr(n.right, 'value', ''), '"')
+                                    assignments.append((k, v))
+                            calls.append(assignments)
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+    return calls
+
+# Returns the $rwidgets calls of script_text, as _extract_rwidgets_slimit.
+# The fast extractor is used where it understands the script, and slimit
+# otherwise.  If verify, slimit is run too, and its result is used and the
+# discrepancy reported if the two differ.
+def _extract_rwidgets(script_text, verify: bool = False):
+    try:
+        calls = rwidgets.extract_rwidgets(script_text)
+    except rwidgets.UnsupportedScript:
+        return _extract_rwidgets_slimit(script_text)
+
+    if verify:
+        slimit_calls = _extract_rwidgets_slimit(script_text)
+        if calls != slimit_calls:
+            print(colored('notify author: fast $rwidgets extraction differs ' \
+                    'from slimit', 'red'))
+            return slimit_calls
+    return calls
+
+def _parse_rwidgets(script_texts, duplicates, verify: bool = False):
+    raw_values = {}
+    for script_text in script_texts:
+        for assignments in _extract_rwidgets(script_text, verify):
+            fields = {}
+            for k, v in assignments:
+                if k in duplicates:
+                    try:
+                        fields[k].append(v)
+                    except KeyError:
+                        fields[k] = [v]
+                else:
+                    fields[k] = v
+
+            # Merge fields and raw_values, resolving duplicates
+            for (k, v) in fields.items():
+                if k in duplicates:
+                    try:
+                        raw_values[k] += v
+                    except KeyError:
+                        raw_values[k] = v
+                else:
+                    raw_values[k] = v
+    return raw_values
+
+def _parse_2020_auction_soup(soup, duplicates, raw=False):
     div = soup.find('div', id='JSDF')
     scripts = div.find_all('script', src=None)
 
@@ -175,47 +367,8 @@ def _parse_2020_auction_soup(soup, duplicates, raw=False):
             if '$rwidgets' in s:
                 script_texts.append(s)
 
-    # Bodge: until we move from slimit to calmjs
-    sys.stdout = open(os.devnull, "w")
-    sys.stderr = open(os.devnull, "w")
-
     # Parsing js
-    raw_values = {}
-    for script_text in script_texts:
-        parser = Parser()
-        tree = parser.parse(script_text)
-        for node in nodevisitor.visit(tree):
-            if isinstance(node, ast.FunctionCall):
-                if isinstance(node.identifier, ast.Identifier):
-                    if node.identifier.value == '$rwidgets':
-                        # Deal with here
-                        fields = {}
-                        for n in nodevisitor.visit(node):
-                            if isinstance(n, ast.Assign):
-                                k = getattr(n.left, 'value', '').strip('"')
-                                v = strip(getattr(n.right, 'value', ''), '"')
-                                if k in duplicates:
-                                    try:
-                                        fields[k].append(v)
-                                    except KeyError:
-                                        fields[k] = [v]
-                                else:
-                                    fields[k] = v
-
-                        # Merge fields and raw_values, resolving duplicates
-                        for (k, v) in fields.items():
-                            if k in duplicates:
-                                try:
-                                    raw_values[k] += v
-                                except KeyError:
-                                    raw_values[k] = v
-                            else:
-                                raw_values[k] = v
-                        #raw_values = {**raw_values, **fields}
-    # Bodge: until we move from slimit to calmjs
-    sys.stdout = open(os.devnull, "w")
-    sys.stdout = sys.__stdout__
-    sys.stderr = sys.__stderr__
+    raw_values = _parse_rwidgets(script_texts, duplicates)
 
     if raw:
         return raw_values
@@ -233,7 +386,9 @@ def _parse_2020_auction_soup(soup, duplicates, raw=False):
     else:
         title_key = 'it'
 
-    if raw_values['kw'] != raw_values['it']:
+    url = _get_dict_value(raw_values, 'currentDomain')
+    if 'kw' in raw_values and 'it' in raw_values \
+            and raw_values['kw'] != raw_values['it']:
         print(colored(f'notify author: kw==it assumption incorrect for domain {url}.', 'red'))
     try:
         if raw_values['entityId'] != raw_values['entityName']:
@@ -304,19 +459,77 @@ def _parse_2020_auction_soup(soup, duplicates, raw=False):
         'description': desc
     }
 
+# Raised when an auction page cannot be parsed.  page_format is the format it
+# was detected as, or None if it matched none, and the cause is chained.
+class AuctionParseError(ValueError):
+    def __init__(self, page_format, cause):
+        self.page_format = page_format
+        self.cause = cause
+        super().__init__('Could not parse {} web page: {!r}'.format( \
+                page_format or 'unrecognised', cause))
+
+_AUCTION_PARSERS = {
+    '2020': _parse_2020_auction_soup,
+    '2010': _parse_2010_auction_soup,
+    'ancient': _parse_ancient_auction_soup
+}
+
+# Counts, per detected format, the pages parsed and the parse failures, along
+# with the most recent failure
+_format_stats_lock = threading.Lock()
+_format_stats = {f: {'parsed': 0, 'failed': 0, 'last_error': None} \
+        for f in [*_AUCTION_PARSERS, None]}
+
+def _record_format(page_format, error=None):
+    with _format_stats_lock:
+        s = _format_stats[page_format]
+        if error is None:
+            s['parsed'] += 1
+        else:
+            s['failed'] += 1
+            s['last_error'] = repr(error)
+
+# Returns a copy of the per-format counters, keyed by format, and None for
+# pages that matched no format
+def auction_format_stats():
+    with _format_stats_lock:
+        return {f: dict(s) for f, s in _format_stats.items()}
+
+# Classifies an auction page by its markers, without parsing it, returning
+# None if it matches none
+def _detect_auction_format(soup):
+    if soup.find('div', id='JSDF') is not None:
+        return '2020'
+    if soup.find('div', attrs={'class': 'item_description'}) is not None:
+        return '2010'
+    if soup.find('a', attrs={'name': 'description'}) is not None \
+            and soup.find('td', text=re.compile('.*Item number:.*')) is not None:
+        return 'ancient'
+    return None
+
 # duplicates - a list of keys with permitted duplicates
 def _parse_auction_page(soup, duplicates: List[str], raw: bool = False):
-    # Try various parsing methods until one works
-    try:
-        return _parse_2020_auction_soup(soup, duplicates, raw)
-    except Exception:
+    page_format = _detect_auction_format(soup)
+    if page_format is not None:
         try:
-            return _parse_2010_auction_soup(soup, duplicates, raw)
-        except Exception:
-            try:
-                return _parse_ancient_auction_soup(soup, duplicates, raw)
-            except Exception:
-                raise ValueError('Could not parse web page')
+            a = _AUCTION_PARSERS[page_format](soup, duplicates, raw)
+        except Exception as e:
+            _record_format(page_format, e)
+            raise AuctionParseError(page_format, e) from e
+        _record_format(page_format)
+        return a
+
+    # Unrecognised: try each parser until one works
+    for parse in _AUCTION_PARSERS.values():
+        try:
+            a = parse(soup, duplicates, raw)
+        except Exception as e:
+            error = e
+            continue
+        _record_format(None)
+        return a
+    _record_format(None, error)
+    raise AuctionParseError(None, error) from error
 
 # Generates a search URL
 def _generate_search_url(query_string: str, page_num: int, \
@@ -331,8 +544,8 @@ def _generate_search_url(query_string: str, page_num: int, \
     return urljoin(base_url, suffix)
 
 # Returns a list of dict of products
-def _parse_search_page(page_text):
-    soup = BeautifulSoup(page_text, 'html.parser')
+def _parse_search_page(page_text, html_parser: str = 'html.parser'):
+    soup = _make_soup(page_text, html_parser)
     auctions_list = soup.find('ul', id='ListViewInner')
     results = auctions_list.find_all('li', recursive=False)
 
@@ -366,38 +579,51 @@ def _parse_search_page(page_text):
     return auctions
 
 
-# Returns up to n_results
-def scrape_search_page(query_string: str, n_results: int = 50, \
-        base: str = 'https://www.ebay.com'):
-    results = {}
+# Yields the results of each search page in turn, as a dict of products not
+# seen on an earlier page, until n_results have been yielded in total
+def iter_search_page(query_string: str, n_results: int = 50, \
+        base: str = 'https://www.ebay.com', transport=None, \
+        html_parser: str = 'html.parser'):
+    transport = transport or get_default_transport()
+    n_yielded = 0
+    seen = set()
     n_page = 1
-    while len(results) < n_results:
+    while n_yielded < n_results:
         url = _generate_search_url(query_string, n_page, base)
-        r = requests.get(url)
+        r = transport.get(url, cached=True)
         if not r.ok:
             raise ValueError('The requested page could not be found')
-        res = _parse_search_page(r.text)
-        n_res = len(results)
-        results = {**results, **_parse_search_page(r.text)}
-        if len(results) == n_res:
+        res = {k: v for k, v in _parse_search_page(r.text, \
+                html_parser).items() if k not in seen}
+        if not res:
             break
+        seen.update(res.keys())
+
+        # Truncate the final page to n_results
+        res = dict(list(res.items())[:n_results - n_yielded])
+        n_yielded += len(res)
+        yield res
         n_page += 1
 
-    while len(results) > n_results:
-        results.popitem()
+# Returns up to n_results
+def scrape_search_page(query_string: str, n_results: int = 50, \
+        base: str = 'https://www.ebay.com', transport=None, \
+        html_parser: str = 'html.parser'):
+    results = {}
+    for res in iter_search_page(query_string, n_results, base, transport, \
+            html_parser):
+        results = {**results, **res}
     return results
 
-# profile can be a URL or a profile ID
+# profile can be a URL or a profile ID.  If archive, an archive.PageArchive, is
+# given, the raw page is stored in it.
 def scrape_profile_page(profile: str, base: str = 'https://www.ebay.com', \
-        page_save_path=None):
-    if urlparse(profile).netloc == '':
-        url = _generate_profile_url(profile, base)
-        profile_id = profile
-    else:
-        url = profile
-        profile_id = urlparse(url).path.split('/')[-1]
+        page_save_path=None, transport=None, html_parser: str = 'html.parser', \
+        archive=None):
+    transport = transport or get_default_transport()
+    url, profile_id = _profile_url_and_id(profile, base)
 
-    r = requests.get(url)
+    r = transport.get(url, cached=True)
     if not r.ok:
         raise ValueError('The requested page could not be found')
 
@@ -405,21 +631,29 @@ def scrape_profile_page(profile: str, base: str = 'https://www.ebay.com', \
     if page_save_path is not None:
         profile_path = page_save_path.joinpath(f'{profile_id}.html')
         with open(profile_path, 'w') as f:
-            soup = BeautifulSoup(text, 'html.parser')
+            soup = _make_soup(text, html_parser)
             f.write(soup.prettify())
+    if archive is not None:
+        archive.put('profile', profile_id, r.content, url, r.encoding)
 
-    d = _parse_profile_page(text)
+    d = _parse_profile_page(text, html_parser)
     d['url'] = url
     d['profile_id'] = profile_id
     return d
 
+# Returns the URL and ID of profile, given as either its ID or its URL
+def _profile_url_and_id(profile: str, base: str):
+    if urlparse(profile).netloc == '':
+        return _generate_profile_url(profile, base), profile
+    return profile, urlparse(profile).path.split('/')[-1]
+
 def _generate_profile_url(profile_id: int, base_url: str):
     page_suffix = '/usr/{}'
     suffix = page_suffix.format(profile_id)
     return urljoin(base_url, suffix)
 
-def _parse_profile_page(page_text):
-    soup = BeautifulSoup(page_text, 'html.parser')
+def _parse_profile_page(page_text, html_parser: str = 'html.parser'):
+    soup = _make_soup(page_text, html_parser)
 
     description = soup.find('h2', attrs={'class': 'bio inline_value'}).get_text(strip=True)
 
@@ -0,0 +1,235 @@
+import threading
+import time
+import random
+import fnmatch
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+# Statuses with which hosts throttle requests, which are retried
+THROTTLED_STATUSES = {429, 503}
+
+class ThrottledError(ValueError):
+    def __init__(self, url, status_code, retries):
+        self.url = url
+        self.status_code = status_code
+        self.retries = retries
+        super().__init__('Throttled fetching {} ({}) after {} retries' \
+                .format(url, status_code, retries))
+
+# A token bucket limiting the requests to one host to rate per second, in
+# bursts of up to a second's worth, or unlimited if rate is None.  The host can
+# also be paused, such as for its Retry-After.
+class _HostLimiter():
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.burst = max(rate, 1) if rate is not None else None
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    # Takes a token, returning how long to wait before using it.  Tokens may
+    # be taken ahead of time, so waiters are served in turn.
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0)
+            if self.rate is not None:
+                self._tokens = min(self.burst, self._tokens + \
+                        (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def pause(self, delay):
+        with self._lock:
+            self._paused_until = max(self._paused_until, \
+                    time.monotonic() + delay)
+
+# Returns the delay asked for by the Retry-After header of r, in seconds, or
+# None if it has none
+def _retry_after(r):
+    value = r.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0)
+
+# A shared HTTP transport for all scraper fetches.  Connections are pooled per
+# host and kept alive between requests, so consecutive pages, iframes and
+# images from the same host skip the TCP and TLS handshakes.
+#
+# If a cache.ResponseCache is given, fetches made with cached=True are served
+# from and stored in it.
+#
+# Requests to each host are limited to the rate, in requests per second, of
+# the first pattern of rate_limits matching it, or else to default_rate, if
+# given.  Throttled requests are retried up to max_retries times, after the
+# delay the host asks for in Retry-After, if any, during which the host is
+# paused, or else after a jittered exponential backoff from backoff seconds,
+# of at most max_backoff.
+class Transport():
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10, \
+            timeout: float = 30, headers: dict = None, cache=None, \
+            rate_limits: dict = None, default_rate: float = None, \
+            max_retries: int = 4, backoff: float = 1, \
+            max_backoff: float = 60):
+        self.timeout = timeout
+        self.cache = cache
+        for rate in [default_rate, *(rate_limits or {}).values()]:
+            if rate is not None and rate <= 0:
+                raise ValueError('Rate limits must be positive')
+        if max_retries < 0:
+            raise ValueError('max_retries must not be negative')
+        self.rate_limits = dict(rate_limits or {})
+        self.default_rate = default_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        if headers is not None:
+            self.session.headers.update(headers)
+
+        # pool_connections is the number of hosts to keep pools for, and
+        # pool_maxsize the number of connections kept alive to each host
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, \
+                pool_maxsize=pool_maxsize)
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._n_requests = {}
+        self._limiters = {}
+        self._throttle_stats = {}
+
+    def get(self, url, cached: bool = False, **kwargs):
+        if cached and self.cache is not None:
+            return self._get_cached(url, **kwargs)
+        return self._get(url, **kwargs)
+
+    # Returns the limiter of host, and its throttling counters
+    def _limiter(self, host):
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                rate = self.default_rate
+                for pattern, r in self.rate_limits.items():
+                    if fnmatch.fnmatch(host or '', pattern):
+                        rate = r
+                        break
+                limiter = self._limiters[host] = _HostLimiter(rate)
+                self._throttle_stats[host] = {'throttled': 0, 'retries': 0, \
+                        'wait': 0, 'max_wait': 0}
+            return limiter, self._throttle_stats[host]
+
+    def _get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).hostname
+        limiter, stats = self._limiter(host)
+        for attempt in range(self.max_retries + 1):
+            wait = limiter.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            with self._lock:
+                self._n_requests[host] = self._n_requests.get(host, 0) + 1
+                stats['wait'] += wait
+                stats['max_wait'] = max(stats['max_wait'], wait)
+
+            r = self.session.get(url, **kwargs)
+            if r.status_code not in THROTTLED_STATUSES:
+                return r
+            with self._lock:
+                stats['throttled'] += 1
+            if attempt == self.max_retries:
+                r.close()
+                raise ThrottledError(url, r.status_code, attempt)
+
+            # The host is paused for as long as it asks, and the request
+            # retried after a random share of its exponential backoff
+            delay = _retry_after(r)
+            r.close()
+            if delay is not None:
+                limiter.pause(min(delay, self.max_backoff))
+            else:
+                delay = random.uniform(0, min(self.max_backoff, \
+                        self.backoff * 2**attempt))
+                time.sleep(delay)
+                with self._lock:
+                    stats['wait'] += delay
+                    stats['max_wait'] = max(stats['max_wait'], delay)
+            with self._lock:
+                stats['retries'] += 1
+
+    def _get_cached(self, url, **kwargs):
+        entry = self.cache.lookup(url)
+        if entry is None:
+            r = self._get(url, **kwargs)
+            self.cache.record(hit=False)
+            if r.status_code == 200:
+                self.cache.store(url, r)
+            return r
+
+        meta, body = entry
+        if self.cache.is_fresh(meta):
+            self.cache.touch(url, meta)
+            self.cache.record(hit=True, size=len(body))
+            return self.cache.response(url, meta, body)
+
+        # Revalidate the stale entry
+        headers = {**kwargs.pop('headers', {}), \
+                **self.cache.conditional_headers(meta)}
+        r = self._get(url, headers=headers, **kwargs)
+        if r.status_code == 304:
+            self.cache.touch(url, meta, revalidated=True)
+            self.cache.record(hit=True, revalidated=True, size=len(body))
+            return self.cache.response(url, meta, body)
+
+        self.cache.record(hit=False, revalidated=True)
+        if r.status_code == 200:
+            self.cache.store(url, r)
+        return r
+
+    # Returns, per host, the number of requests made, the number of
+    # connections opened to serve them, the number throttled and retried,
+    # and the total and longest time requests waited for the rate limit and
+    # backoff, in seconds
+    def stats(self):
+        with self._lock:
+            stats = {host: {'requests': n, 'connections': None, \
+                    **self._throttle_stats[host]} \
+                    for host, n in self._n_requests.items()}
+
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.host not in stats:
+                continue
+            # Pools are keyed by scheme and port too, so a host may have several
+            s = stats[pool.host]
+            s['connections'] = (s['connections'] or 0) + pool.num_connections
+        return stats
+
+    def close(self):
+        self.session.close()
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+# Returns the module-wide transport used when none is supplied
+def get_default_transport():
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
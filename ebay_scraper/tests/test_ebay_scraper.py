@@ -1,5 +1,532 @@
+import importlib.util
+import os
+import pathlib
+import random
+import sqlite3
+import sys
+import time
+
 from ebay_scraper import __version__
+from ebay_scraper import archive, db_interface, phash, rwidgets, scraper, \
+        transport
+
+# The importers are scripts beside the package rather than modules within it
+_REPO = pathlib.Path(__file__).parent.parent.parent
+
+def _load_script(path):
+    spec = importlib.util.spec_from_file_location(path.stem.replace('-', '_'), \
+            path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered, so that worker processes can find its functions by name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+_RWIDGETS_SCRIPTS = [
+    '$rwidgets(["W", {"a": "x", b: 1, \'c\': true, d: null, e: .5}]);',
+    '$rwidgets(["W", {"maxImageUrl": "a.jpg", "displayImgUrl": "b.jpg"}],' \
+            ' ["W", {"maxImageUrl": "c.jpg", "displayImgUrl": "d.jpg"}]);',
+    'var x = a / 2; // $rwidgets({a: 1})\n$rwidgets({a: [1, 2], b: {c: 3},' \
+            ' d: f(1), e: x.y, f: "q\\"r", g: /a\\/b/g});',
+    '$rwidgets({a: $rwidgets({b: 1}), get: 2, set: 3});',
+    '$rwidgets({a: -1, b: !0, c: typeof y, d: void 0});',
+]
+
+def test_rwidgets_matches_slimit():
+    for script in _RWIDGETS_SCRIPTS:
+        assert rwidgets.extract_rwidgets(script) \
+                == scraper._extract_rwidgets_slimit(script)
+
+def test_rwidgets_unsupported_falls_back():
+    for script in ['$rwidgets({a: -x.y})', '$rwidgets({a: b ? 1 : 2})', \
+            '$rwidgets({a: function() {}})', '$rwidgets({a: `b`})']:
+        try:
+            rwidgets.extract_rwidgets(script)
+            assert False
+        except rwidgets.UnsupportedScript:
+            pass
+        # slimit still handles them
+        assert len(scraper._extract_rwidgets(script, verify=True)) == 1
+
+def test_parse_rwidgets_duplicates():
+    duplicates = ['maxImageUrl', 'displayImgUrl']
+    raw_values = scraper._parse_rwidgets(_RWIDGETS_SCRIPTS[1:2], duplicates)
+    assert raw_values['maxImageUrl'] == ['a.jpg', 'c.jpg']
+    assert raw_values['displayImgUrl'] == ['b.jpg', 'd.jpg']
+
+
+_DATA = pathlib.Path(__file__).parent.joinpath('data')
+
+def test_auction_parsers_agree_across_backends():
+    for name in ['auction_2020', 'auction_2010', 'auction_ancient']:
+        url = _DATA.joinpath(name + '.html').resolve().as_uri()
+        records = [scraper.scrape_auction_page(url, html_parser=p) \
+                for p in scraper.HTML_PARSERS]
+        assert records[0]['auction_id'] is not None
+        for record in records[1:]:
+            assert record == records[0]
+
+def test_search_and_profile_parsers_agree_across_backends():
+    search = _DATA.joinpath('search.html').read_text()
+    profile = _DATA.joinpath('profile.html').read_text()
+    results = [(scraper._parse_search_page(search, p), \
+            scraper._parse_profile_page(profile, p)) \
+            for p in scraper.HTML_PARSERS]
+    assert list(results[0][0].keys()) == [111111111111, 333333333333]
+    for result in results[1:]:
+        assert result == results[0]
+
+def test_auction_format_dispatch():
+    for name, page_format in [('auction_2020', '2020'), \
+            ('auction_2010', '2010'), ('auction_ancient', 'ancient')]:
+        soup = scraper._make_soup(_DATA.joinpath(name + '.html').read_text())
+        assert scraper._detect_auction_format(soup) == page_format
+
+    # A broken 2020 page reports the 2020 parser's failure
+    soup = scraper._make_soup('<div id="JSDF"></div>')
+    before = scraper.auction_format_stats()['2020']['failed']
+    try:
+        scraper._parse_auction_page(soup, [])
+        assert False
+    except scraper.AuctionParseError as e:
+        assert e.page_format == '2020'
+    assert scraper.auction_format_stats()['2020']['failed'] == before + 1
+
+
+def test_batched_writes_are_read_back(tmp_path):
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path, \
+            batch_size=4, flush_interval=10)
+    for i in range(10):
+        e._merge_and_write_profile({'profile_id': 'p{}'.format(i), \
+                'description': 'd', 'location': None, 'member_since': None, \
+                'member_since_unix': None, 'n_followers': None, \
+                'n_reviews': None, 'percent_positive_feedback': None})
+    # A failed write is rolled back alone
+    failed = e._db_write(lambda c: c.execute('INSERT INTO nowhere VALUES (1)'))
+    n = e._db_read(lambda c: \
+            c.execute('SELECT COUNT(*) FROM ebay_profiles').fetchone()[0])
+    assert n == 10
+    assert failed.exception() is not None
+    e.close()
+
+
+def test_upserts_match_reference_merge(tmp_path):
+    reference = db_interface.EbayScraper(tmp_path.joinpath('ref.db'), tmp_path)
+    upsert = db_interface.EbayScraper(tmp_path.joinpath('new.db'), tmp_path)
+    columns = [c for c in reference.ebay_auctions_entries if c != 'auction_id']
+    values = [None, 0, 1, 5, 2.5, True, '', '1', 'USD', 'GBP', 'abc']
+    rng = random.Random(0)
+
+    def outcome(e, f, table, key, value):
+        try:
+            e._db_transaction(f)
+            error = None
+        except Exception as exception:
+            error = type(exception)
+        rows = e._db_read(lambda c: c.execute('SELECT * FROM {} WHERE {}=?' \
+                .format(table, key), (value,)).fetchall())
+        return error, rows, [[type(v) for v in row] for row in rows]
+
+    for auction_id in range(300):
+        for _ in range(3):
+            a = {'auction_id': auction_id}
+            for c in rng.sample(columns, rng.randint(0, len(columns))):
+                a[c] = rng.choice(values)
+            assert outcome(reference, lambda c: \
+                    db_interface._merge_and_write_auction_reference(c, \
+                    dict(a), reference.ebay_auctions_entries), \
+                    'ebay_auctions', 'auction_id', auction_id) \
+                    == outcome(upsert, lambda c: upsert._upsert(c, \
+                    db_interface._auction_upsert_sql(a), a), \
+                    'ebay_auctions', 'auction_id', auction_id)
+
+    for profile_id in range(100):
+        for n in [7, 5]:
+            p = {'profile_id': str(profile_id), 'url': ''}
+            for c in rng.sample(db_interface._PROFILE_SCRAPED_COLUMNS, n):
+                p[c] = rng.choice(values)
+            assert outcome(reference, lambda c: \
+                    db_interface._merge_and_write_profile_reference(c, \
+                    dict(p), reference.ebay_profiles_entries), \
+                    'ebay_profiles', 'profile_id', p['profile_id']) \
+                    == outcome(upsert, lambda c: upsert._upsert(c, \
+                    db_interface._profile_upsert_sql(p), p), \
+                    'ebay_profiles', 'profile_id', p['profile_id'])
+    reference.close()
+    upsert.close()
+
+
+def test_image_paths_migrate_to_auction_images(tmp_path):
+    db_path = tmp_path.joinpath('db.db')
+    image = tmp_path.joinpath('a.jpg')
+    image.write_bytes(b'abc')
+    c = sqlite3.connect(db_path)
+    c.execute('''CREATE TABLE ebay_auctions (auction_id INTEGER NOT NULL
+            PRIMARY KEY, title TEXT, image_paths TEXT NOT NULL)''')
+    c.execute("INSERT INTO ebay_auctions VALUES (1, 't', ?)", \
+            ('{}:b.jpg'.format(image),))
+    c.execute("INSERT INTO ebay_auctions VALUES (2, 'u', '')")
+    c.commit()
+    c.close()
+
+    e = db_interface.EbayScraper(db_path, tmp_path)
+    assert 'image_paths' not in e.ebay_auctions_entries
+    e._db_transaction(lambda c: c.execute(db_interface._APPEND_IMAGE_SQL, \
+            {'auction_id': 1, 'url': 'http://x/c.jpg', 'path': 'c.jpg', \
+            'size': None, 'hash': None}))
+    images = e._db_read(lambda c: c.execute('''SELECT auction_id, position,
+            path, size FROM auction_images ORDER BY position''').fetchall())
+    assert images == [(1, 0, str(image), 3), (1, 1, 'b.jpg', None), \
+            (1, 2, 'c.jpg', None)]
+    rows = e._db_read(lambda c: c.execute('''SELECT auction_id, title,
+            image_paths FROM ebay_auctions_with_image_paths
+            ORDER BY auction_id''').fetchall())
+    assert rows == [(1, 't', '{}:b.jpg:c.jpg'.format(image)), (2, 'u', '')]
+    assert e._db_read(lambda c: \
+            c.execute('PRAGMA user_version').fetchone()[0]) \
+            == db_interface._SCHEMA_VERSION
+    e.close()
+
+def test_query_auctions(tmp_path):
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path)
+    for i in range(20):
+        a = {'auction_id': i, 'seller': 's{}'.format(i % 2), 'end_time': i, \
+                'price': 10 * i, 'currency_code': 'USD', 'n_bids': i % 5}
+        e._db_transaction(lambda c: e._upsert(c, \
+                db_interface._auction_upsert_sql(a), a))
+
+    ids = lambda **kwargs: [a['auction_id'] for a in e.query_auctions(**kwargs)]
+    assert ids(seller='s1', ended_after=5, ended_before=11, \
+            order_by='end_time') == [5, 7, 9]
+    assert ids(min_price=150, currency_code='USD', max_bids=2, \
+            order_by='price') == [15, 16, 17]
+    assert ids(order_by='n_bids', limit=3) == [0, 5, 10]
+
+    # The filters are served by the secondary indexes
+    for kwargs, index in [({'seller': 's1', 'ended_after': 5}, \
+            'ebay_auctions_seller_end_time'), ({'ended_before': 5}, \
+            'ebay_auctions_end_time'), ({'currency_code': 'USD', \
+            'min_price': 100}, 'ebay_auctions_currency_price')]:
+        sql, params = db_interface._query_auctions_sql(**kwargs)
+        plan = e._db_read(lambda c: c.execute('EXPLAIN QUERY PLAN ' + sql, \
+                params).fetchall())
+        assert index in str(plan)
+    e.close()
+
+def test_search_local_follows_writes(tmp_path):
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path)
+    def write(a):
+        e._db_transaction(lambda c: e._upsert(c, \
+                db_interface._auction_upsert_sql(a), a))
+    write({'auction_id': 1, 'title': 'Mambila mask', \
+            'description': 'Carved wooden mask'})
+    write({'auction_id': 2, 'title': 'Bronze figure', \
+            'description': 'A figure with a mask'})
+    write({'auction_id': 3, 'title': 'Stool', 'description': None})
+
+    ids = lambda q: [a['auction_id'] for a in e.search_local(q)]
+    # Title matches rank first, and words are stemmed
+    assert ids('masks') == [1, 2]
+    assert ids('carved') == [1]
+    assert '[mask]' in next(e.search_local('figure mask'))['snippet']
+
+    # Updates and deletes are followed
+    write({'auction_id': 3, 'title': 'Carved stool'})
+    e._db_transaction(lambda c: \
+            c.execute('DELETE FROM ebay_auctions WHERE auction_id = 1'))
+    assert ids('carved') == [3]
+    e.rebuild_search_index()
+    e._db_transaction(lambda c: c.execute("INSERT INTO ebay_auctions_fts " \
+            "(ebay_auctions_fts, rank) VALUES ('integrity-check', 1)"))
+    assert ids('carved OR mask') == [3, 2]
+    e.close()
+
+
+def test_page_archive(tmp_path):
+    a = archive.PageArchive(tmp_path, max_pack_size=50)
+    pages = [bytes([i]) * 1000 for i in range(3)]
+    for i, page in enumerate(pages):
+        a.put('auction', i, page, fetched=1)
+    # Unchanged pages are stored once
+    a.put('auction', 0, pages[0], fetched=2)
+    a.put('auction', 1, pages[2], fetched=2)
+    assert len(list(tmp_path.glob('*.pack'))) == 3
+    a.close()
+
+    a = archive.PageArchive(tmp_path)
+    assert a.get('auction', 1) == pages[2]
+    assert a.get('auction', 1, fetched=1) == pages[1]
+    assert a.get('profile', 1) is None
+    assert [(p['page_id'], p['fetched']) for p in a.pages('auction')] \
+            == [('0', 1), ('1', 1), ('2', 1), ('0', 2), ('1', 2)]
+    a.close()
+
+def test_reparse_auctions(tmp_path):
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path)
+    expected = {}
+    for i, name in enumerate(['auction_2010', 'auction_2020']):
+        path = _DATA.joinpath(name + '.html')
+        e.archive.put('auction', 100 + i, path.read_bytes(), \
+                path.resolve().as_uri(), 'utf-8', fetched=i)
+        expected[name] = scraper.scrape_auction_page(path.resolve().as_uri())
+    # Pages saved as HTML before the archive are reparsed too
+    e.auction_page_location.mkdir()
+    e.auction_page_location.joinpath('102.html').write_bytes( \
+            _DATA.joinpath('auction_ancient.html').read_bytes())
+
+    results = list(e.reparse_auctions(formats=['2020'], jobs=2))
+    assert sorted((r[0], r[1], r[2] is None) for r in results) == \
+            [('100', '2010', True), ('101', '2020', False), \
+            ('102', 'ancient', True)]
+    assert [r[0] for r in e.reparse_auctions(min_id=101, max_id=101, \
+            jobs=1)] == ['101']
+
+    # Replacing restores the columns parsed, where merging keeps those of a row
+    # no older than the page
+    auction_id = expected['auction_2020']['auction_id']
+    e._db_transaction(lambda c: c.execute('UPDATE ebay_auctions SET ' \
+            "description = 'edited' WHERE auction_id = ?", (auction_id,)))
+    description = lambda: e._db_read(lambda c: c.execute('SELECT ' \
+            'description FROM ebay_auctions WHERE auction_id = ?', \
+            (auction_id,)).fetchone()[0])
+    list(e.reparse_auctions(fetched_after=1, jobs=1))
+    assert description() == 'edited'
+    list(e.reparse_auctions(fetched_after=1, jobs=1, replace=True))
+    assert description() == expected['auction_2020']['description']
+    # The 2010 page, fetched before fetched_after, was never written
+    n = e._db_read(lambda c: \
+            c.execute('SELECT COUNT(*) FROM ebay_auctions').fetchone()[0])
+    assert n == 2
+    e.close()
+
+def test_refresh_schedule(tmp_path):
+    day = 86400
+    # Closer to the end, sooner; ended and scraped since, never
+    assert db_interface._next_refresh(10 * day, 1, 0, 300, day) == day
+    assert db_interface._next_refresh(10 * day, 0, 0, 300, day) == day
+    assert db_interface._next_refresh(day, 1, 0, 300, day) == day / 10
+    assert db_interface._next_refresh(day, 1, day - 60, 300, day) == day + 60
+    assert db_interface._next_refresh(day, 1, day + 60, 300, day) is None
+    assert db_interface._next_refresh(day, 1, None, 300, day) == 0
+
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path)
+    now = int(time.time())
+    rows = {1: (now - day, now), 2: (now + day, None), 3: (now + day, now), \
+            4: (now - day, now - 2 * day)}
+    e._db_transaction(lambda c: c.executemany('INSERT INTO ebay_auctions ' \
+            '(auction_id, end_time, n_bids, last_scraped) VALUES (?, ?, 1, ?)', \
+            [(i, end, last) for i, (end, last) in rows.items()]))
+    scraped = []
+    def scrape(auction_id, base):
+        scraped.append(auction_id)
+        return {'auction_id': auction_id, 'end_time': rows[auction_id][0], \
+                'n_bids': 1, 'last_scraped': int(time.time())}
+    e.scrape_auction_to_db = scrape
+    # Only the auctions never scraped, or not since they ended, are due
+    results = list(e.refresh_auctions(concurrency=2))
+    assert sorted(scraped) == [2, 4]
+    assert all(exception is None for _, _, exception in results)
+    e.close()
+
+class _ImageResponse():
+    ok = True
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size):
+        return [self.data[i:i + chunk_size] \
+                for i in range(0, len(self.data), chunk_size)]
+
+    def close(self):
+        pass
+
+class _ImageTransport():
+    def __init__(self, images):
+        self.images = images
+        self.fetched = []
+
+    def get(self, url, stream=False):
+        self.fetched.append(url)
+        return _ImageResponse(self.images[url])
+
+def test_images_are_stored_by_content(tmp_path):
+    transport = _ImageTransport({'http://i/a/1.jpg': b'a' * 1000, \
+            'http://i/b/1.jpg': b'a' * 1000, 'http://i/c/1.jpg': b'c'})
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path, \
+            transport)
+    e._store_images(['http://i/a/1.jpg', 'http://i/c/1.jpg'], 1)
+    # Known URLs are not fetched again, and the same bytes are stored once
+    images = e._store_images(['http://i/a/1.jpg', 'http://i/b/1.jpg'], 2)
+    assert sorted(transport.fetched) == \
+            ['http://i/a/1.jpg', 'http://i/b/1.jpg', 'http://i/c/1.jpg']
+    assert len([p for p in e.image_location.rglob('*') if p.is_file()]) == 2
+    assert images[0]['path'] == images[1]['path']
+    assert pathlib.Path(images[0]['path']).name.endswith('.jpg')
+    n = e._db_read(lambda c: c.execute('SELECT COUNT(*) FROM ' \
+            'auction_images WHERE auction_id = 1').fetchone()[0])
+    assert n == 2
+    e.close()
+
+
+def test_find_duplicate_auctions(tmp_path):
+    assert len(phash.chunk_neighbours(0, 1)) == 1 + phash.CHUNK_BITS
+    assert phash.to_unsigned(phash.to_signed(2**64 - 1)) == 2**64 - 1
+
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path)
+    rng = random.Random(0)
+    original = rng.getrandbits(64)
+    # A bit flipped in every chunk still leaves the copy within 6 bits
+    copy = original ^ sum(1 << (16 * i + 3) for i in range(4))
+    images = {'a': original, 'b': copy, 'c': original ^ (2**64 - 1)}
+    images.update({'r{}'.format(i): rng.getrandbits(64) for i in range(1000)})
+    auctions = [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'a'), (4, 'b')] + \
+            [(10 + i, 'r{}'.format(i)) for i in range(1000)]
+
+    @e._db_transaction
+    def _(c):
+        c.executemany('INSERT INTO image_phashes VALUES (?, ?, ?, ?, ?, ?)', \
+                [(h, phash.to_signed(p), *phash.chunks(p)) \
+                for h, p in images.items()])
+        c.executemany("INSERT INTO auction_images VALUES (?, ?, '', ?, 0, ?)", \
+                [(a, i, h, h) for i, (a, h) in enumerate(auctions)])
+        c.execute("INSERT INTO ebay_auctions (auction_id, title) " \
+                "VALUES (4, 'Mask')")
+
+    results = e.find_duplicate_auctions(1)
+    assert [(a['auction_id'], a['distance'], a['n_images']) \
+            for a in results] == [(4, 0, 2), (2, 4, 1)]
+    assert results[0]['title'] == 'Mask'
+    assert [a['auction_id'] for a in e.find_duplicate_auctions(1, 3)] == [4]
+    e.close()
+
+
+class _StatusResponse():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+def test_transport_rate_limits_and_retries():
+    limiter = transport._HostLimiter(10)
+    assert [limiter.reserve() for _ in range(10)] == [0] * 10
+    assert 0.09 < limiter.reserve() <= 0.1
+
+    t = transport.Transport(rate_limits={'www.ebay.*': 10}, backoff=0.01)
+    assert t._limiter('www.ebay.co.uk')[0].rate == 10
+    assert t._limiter('i.ebayimg.com')[0].rate is None
+
+    statuses = [_StatusResponse(429, {'Retry-After': '0'}), \
+            _StatusResponse(503), _StatusResponse(200)]
+    t.session.get = lambda url, **kwargs: statuses.pop(0)
+    assert t.get('https://www.ebay.com/itm/1').status_code == 200
+    s = t.stats()['www.ebay.com']
+    assert (s['requests'], s['throttled'], s['retries']) == (3, 2, 2)
+
+    t.max_retries = 1
+    t.session.get = lambda url, **kwargs: _StatusResponse(429)
+    try:
+        t.get('https://www.ebay.com/itm/1')
+        assert False
+    except transport.ThrottledError as e:
+        assert e.status_code == 429 and e.retries == 1
+    t.close()
+
+def test_crawl_jobs_resume(tmp_path):
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path)
+    scraped = []
+    def scrape(auction, base):
+        scraped.append(auction)
+        if auction == '2':
+            raise ValueError('Throttled')
+        return {'auction_id': int(auction)}
+    e.scrape_auction_to_db = scrape
+
+    job_id = e.create_crawl_job('auction', {'base': 'https://www.ebay.com'})
+    results = list(e.scrape_auctions_to_db(['1', '2', '3'], job_id=job_id))
+    assert sorted(a for a, _, exception in results if exception) == ['2']
+    assert e.crawl_job(job_id)['items'] == \
+            {'pending': 0, 'in_flight': 0, 'done': 2, 'failed': 1}
+
+    # Only the failure is retried, until it has had max_attempts
+    scraped.clear()
+    list(e.resume_crawl_job(job_id, max_attempts=2))
+    list(e.resume_crawl_job(job_id, max_attempts=2))
+    assert scraped == ['2']
+    assert e.crawl_jobs() == [job_id]
+    e.close()
+
+def test_fresh_profiles_are_not_fetched(tmp_path, monkeypatch):
+    fetched = []
+    def scrape_profile_page(profile, base, **kwargs):
+        fetched.append(profile)
+        return {'profile_id': profile.split('/')[-1], 'url': profile, \
+                'description': 'd'}
+    monkeypatch.setattr(scraper, 'scrape_profile_page', scrape_profile_page)
+
+    e = db_interface.EbayScraper(tmp_path.joinpath('db.db'), tmp_path, \
+            profile_ttl=3600)
+    assert e.scrape_profile_to_db('seller1')
+    # The same profile, by ID or URL, is fresh until forced
+    assert not e.scrape_profile_to_db('seller1')
+    assert not e.scrape_profile_to_db('https://www.ebay.com/usr/seller1')
+    assert e.scrape_profile_to_db('seller1', force=True)
+    e.profile_ttl = 0
+    assert e.scrape_profile_to_db('seller1')
+    assert fetched == ['seller1'] * 3
+    e.close()
+
+def test_jbidwatcher_import_non_ascii(tmp_path):
+    jbw = _load_script(_REPO.joinpath('jbidwatcher_importer', \
+            'jbidwatcher_importer.py'))
+    # Titles long enough that expat reads them across several chunks
+    titles = {str(i): f'Masque Mambila é {i} ' + 'ü€' * 2000 for i in range(3)}
+    save = tmp_path.joinpath('save.xml')
+    save.write_text('<?xml version="1.0" encoding="ISO-8859-1"?>\n' \
+            '<jbidwatcher><auctions><server>' + ''.join( \
+            f'<auction id="{i}"><info><title>{title}</title>' \
+            '<seller>s</seller></info></auction>' \
+            for i, title in titles.items()) + \
+            '</server></auctions></jbidwatcher>', encoding='utf-8')
+
+    for jobs in [1, 2]:
+        db_path = tmp_path.joinpath(f'{jobs}.db')
+        jbw.main(str(db_path), [str(save)], batch_size=2, jobs=jobs)
+        with sqlite3.connect(db_path) as conn:
+            assert dict(conn.execute('SELECT auction_id, title ' \
+                    'FROM ebay_auctions').fetchall()) == \
+                    {int(i): title for i, title in titles.items()}
+
+def test_jbidwatcher_import_survives_dead_parser(tmp_path, monkeypatch):
+    jbw = _load_script(_REPO.joinpath('jbidwatcher_importer', \
+            'jbidwatcher_importer.py'))
+    paths = []
+    for i in range(3):
+        save = tmp_path.joinpath(f'{i}.xml')
+        save.write_text('<jbidwatcher><auctions><server>' \
+                f'<auction id="{i}"><info><title>t{i}</title>' \
+                '<seller>s</seller></info></auction>' \
+                '</server></auctions></jbidwatcher>')
+        paths.append(str(save))
+
+    # The parser of the second file dies, as if killed
+    normalise_auction = jbw._normalise_auction
+    def _normalise_auction(a):
+        if a['@id'] == '1':
+            os._exit(1)
+        return normalise_auction(a)
+    monkeypatch.setattr(jbw, '_normalise_auction', _normalise_auction)
+
+    db_path = tmp_path.joinpath('db.db')
+    jbw.main(str(db_path), paths, jobs=2)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT auction_id FROM ebay_auctions ' \
+                'ORDER BY auction_id').fetchall() == [(0,), (2,)]
@@ -2,8 +2,10 @@
 import typer
 import xmltodict
 import sqlite3
+import multiprocessing
+import os
+from queue import Empty
 from typing import List
-from collections import OrderedDict
 from termcolor import colored
 import traceback
 from numbers import Number
@@ -74,23 +76,58 @@ def _merge_dicts(d1: dict, d2: dict):
 
 
 
+# The path of each auction element within a save file
+_AUCTION_PATH = ['jbidwatcher', 'auctions', 'server', 'auction']
+
+# Auctions written per transaction
+_BATCH_SIZE = 500
+
+# Reads a text file as UTF-8 bytes, for expat, which xmltodict.parse of the
+# whole file's text did too.  Non-ASCII characters encode to several bytes, so
+# the bytes beyond those asked for are kept for the next read.
+class _Utf8Reader():
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = b''
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.buffer + self.fd.read().encode('utf-8')
+            self.buffer = b''
+            return data
+        while len(self.buffer) < size:
+            text = self.fd.read(size)
+            if not text:
+                break
+            self.buffer += text.encode('utf-8')
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
 ebay_listings_entries = ['auction_id', 'title', 'seller', 'start_time', \
         'end_time', 'n_bids', 'price', 'currency_code', 'buy_now_price', \
-        'starting_price', 'winner', 'location_id', 'image_paths', 'description']
+        'starting_price', 'winner', 'location_id', 'description']
+
+def main(db_path: str, paths: List[str], batch_size: int = _BATCH_SIZE, \
+        jobs: int = 1):
+    try:
+        _create_tables(db_path)
+    except ValueError as e:
+        print(colored(str(e), 'red'))
+        raise typer.Exit(1)
+
+    if jobs > 1:
+        jbw_import_parallel(db_path, paths, jobs, batch_size)
+        return
 
-def main(db_path: str, paths: List[str]):
     for path in paths:
         try:
             print(f'Processing file: {path}')
-            jbw_import(db_path, path)
+            jbw_import(db_path, path, batch_size)
         except Exception:
             print(colored(f'Error processing file: {path}. Skipping...', 'red'))
             print(colored(traceback.format_exc(), 'red'))
 
-            
-
-def jbw_import(db_path, path):
-    # Initialise dbs
+def _create_tables(db_path):
     @_db_transaction_factory(db_path)
     def _(c):
         c.execute('''
@@ -107,7 +144,6 @@ def jbw_import(db_path, path):
                 starting_price INTEGER,
                 winner TEXT,
                 location_id TEXT,  -- Primary key of locations table
-                image_paths TEXT NOT NULL, -- colon-separated paths relative to some base path
                 description TEXT
             )
         ''')
@@ -131,46 +167,201 @@ def jbw_import(db_path, path):
             )
         ''')
 
+        # Images are kept in the auction_images table since ebay-scraper's
+        # schema version 1, which only ebay-scraper migrates to
+        columns = [row[1] for row in \
+                c.execute("pragma table_info('ebay_auctions')").fetchall()]
+        if 'image_paths' in columns:
+            raise ValueError(f'{db_path} has the image_paths column of an ' \
+                    'older ebay-scraper.  Open it with ebay-scraper to ' \
+                    'migrate it first.')
+
+# Streams the save file at path, calling f with each auction as soon as it is
+# parsed.  Parsed auctions are not kept, so memory use is flat whatever the
+# size of the file.
+def _stream_auctions(path, f):
+    def handle(path, a):
+        if [name for name, _ in path] != _AUCTION_PATH:
+            return True
+        # The auction's own attributes are only given in its path by some
+        # versions of xmltodict
+        a = dict(a or {})
+        for k, v in (path[-1][1] or {}).items():
+            a.setdefault('@' + k, v)
+        f(a)
+        return True
+
     with open(path, errors='ignore') as fd:
         print(path)
-        jbw = xmltodict.parse(fd.read())
-
-    auctions = jbw['jbidwatcher']['auctions']['server']['auction']
+        # As for text, the bytes are UTF-8 whatever the file declares
+        xmltodict.parse(_Utf8Reader(fd), encoding='utf-8', \
+                item_depth=len(_AUCTION_PATH), item_callback=handle)
+
+# Runs f(c) for one auction within a savepoint, so that a failure rolls back
+# its writes alone
+def _write_auction(c, f):
+    c.execute('SAVEPOINT auction')
+    try:
+        f(c)
+    except Exception:
+        c.execute('ROLLBACK TO auction')
+        print(colored('Error processing auction. Skipping...'))
+        print(colored(traceback.format_exc(), 'red'))
+    c.execute('RELEASE auction')
+
+# Imports the save file at path into the tables made by _create_tables
+def jbw_import(db_path, path, batch_size: int = _BATCH_SIZE):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute('BEGIN TRANSACTION')
+    n_auctions = 0
+    def handle(a):
+        nonlocal n_auctions
+        _write_auction(conn.cursor(), lambda c: process_auction(a, c))
+        n_auctions += 1
+        if n_auctions % batch_size == 0:
+            conn.execute('COMMIT')
+            conn.execute('BEGIN TRANSACTION')
 
-    for a in auctions:
+    try:
+        _stream_auctions(path, handle)
+        conn.execute('COMMIT')
+    finally:
+        # Closing without committing rolls back the current batch
+        conn.close()
+
+# Set in each parser process of jbw_import_parallel
+_parsed_queue = None
+
+def _init_parser(queue):
+    global _parsed_queue
+    _parsed_queue = queue
+
+# Parses the save file at path, the i-th given, in a parser process, sending
+# that it has started, its normalised auctions in chunks of chunk_size, and
+# then that it is done
+def _parse_file(i, path, chunk_size):
+    _parsed_queue.put(('start', i, os.getpid()))
+    chunk = []
+    def handle(a):
         try:
-            process_auction(a, db_path)
+            chunk.append(_normalise_auction(a))
         except Exception:
             print(colored('Error processing auction. Skipping...'))
             print(colored(traceback.format_exc(), 'red'))
+            return
+        if len(chunk) == chunk_size:
+            _parsed_queue.put(('auctions', list(chunk)))
+            chunk.clear()
 
-def process_auction(a, db_path):
+    try:
+        print(f'Processing file: {path}')
+        _stream_auctions(path, handle)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    if chunk:
+        _parsed_queue.put(('auctions', chunk))
+    _parsed_queue.put(('done', i, error))
+
+# Imports the save files at paths with jobs parser processes.  This process is
+# the single writer: it merges auctions repeated across files in memory, by
+# the same newer-wins rule as _merge_and_write_auction, and writes them in
+# transactions of batch_size auctions.  A file whose parser fails outside of
+# _parse_file, or whose process dies, is skipped as if it had failed to parse.
+def jbw_import_parallel(db_path, paths, jobs: int, \
+        batch_size: int = _BATCH_SIZE):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    pending = {}
+    def write_pending():
+        conn.execute('BEGIN TRANSACTION')
+        _write_auctions(conn.cursor(), pending)
+        conn.execute('COMMIT')
+        pending.clear()
+
+    # Bounded, so that parsers wait for the writer rather than fill memory
+    queue = multiprocessing.Queue(maxsize=4 * jobs)
+    try:
+        with multiprocessing.Pool(jobs, _init_parser, (queue,)) as pool:
+            results = [pool.apply_async(_parse_file, (i, path, batch_size)) \
+                    for i, path in enumerate(paths)]
+            pool.close()
+
+            parser_pids = {}
+            done = set()
+            def file_done(i, error):
+                done.add(i)
+                if error is not None:
+                    print(colored(f'Error processing file: {paths[i]}. ' \
+                            'Skipping...', 'red'))
+                    print(colored(error, 'red'))
+
+            while len(done) < len(paths):
+                try:
+                    message = queue.get(timeout=1)
+                except Empty:
+                    # Nothing has been sent for a while, so check that each
+                    # file yet to finish still has a live parser or is queued
+                    alive = {p.pid for p in multiprocessing.active_children()}
+                    for i, result in enumerate(results):
+                        if i in done:
+                            continue
+                        if result.ready() and not result.successful():
+                            try:
+                                result.get()
+                            except Exception:
+                                file_done(i, traceback.format_exc())
+                        elif i in parser_pids and parser_pids[i] not in alive:
+                            file_done(i, 'Parser process died')
+                    continue
+
+                if message[0] == 'start':
+                    _, i, pid = message
+                    parser_pids[i] = pid
+                    continue
+                if message[0] == 'done':
+                    _, i, error = message
+                    if i not in done:
+                        file_done(i, error)
+                    continue
+
+                for auction_id, auction_dict in message[1]:
+                    try:
+                        existing = pending[auction_id]
+                    except KeyError:
+                        pending[auction_id] = auction_dict
+                    else:
+                        try:
+                            pending[auction_id] = _merge_newer(existing, \
+                                    auction_dict)
+                        except Exception:
+                            print(colored('Error processing auction. ' \
+                                    'Skipping...'))
+                            print(colored(traceback.format_exc(), 'red'))
+                if len(pending) >= batch_size:
+                    write_pending()
+            # The pool waits forever for the result of a dead parser's file
+            if all(result.ready() for result in results):
+                pool.join()
+            else:
+                pool.terminate()
+        write_pending()
+    finally:
+        conn.close()
+
+# Merges the auction a, as parsed by xmltodict, into the database through c
+def process_auction(a, c):
+    auction_id, auction_dict = _normalise_auction(a)
+    _merge_and_write_auction(c, auction_id, auction_dict)
+
+# Returns the auction ID of a, and its entries for ebay_auctions
+def _normalise_auction(a):
     auction = a['info']
     auction_id = a['@id']
 
-    existing_auction_dict = {}
     auction_dict = {}
     for e in ebay_listings_entries:
-        existing_auction_dict[e] = None
         auction_dict[e] = None
 
-    # Determine if an auction of the given id currently exists
-    @_db_transaction_factory(db_path)
-    def existing_entry(c):
-        c.execute('SELECT * FROM ebay_auctions WHERE auction_id=?',\
-                (auction_id,))
-        r = c.fetchall()
-        if not r:
-            return None
-        else:
-            return r[0]
-
-    if existing_entry is not None:
-        # Merge existing entries
-        for name, e in zip(ebay_listings_entries, existing_entry):
-            if e is not None:
-                existing_auction_dict[name] = e
-
     try:
         auction_dict['title'] = auction['title']
     except KeyError as e:
@@ -181,7 +372,7 @@ def process_auction(a, db_path):
         pass
     if isinstance(seller, str):
         auction_dict['seller'] = seller
-    elif isinstance(seller, OrderedDict):
+    elif isinstance(seller, dict):
         auction_dict['seller'] = seller['name']
     elif auction_dict['seller'] is None:
         seller = None
@@ -235,48 +426,118 @@ def process_auction(a, db_path):
     except KeyError:
         pass
 
-    # Merge the auctions into one
+    return auction_id, auction_dict
+
+# Merges auction_dict into existing_auction_dict, both with every entry,
+# preferring the values of whichever is newer
+def _merge_newer(existing_auction_dict, auction_dict):
     current_newer = False
-    if existing_entry is not None:
-        # Determine which entry is newer
-        try:
-            current_newer = auction_dict['n_bids'] > existing_auction_dict['n_bids'] \
-                    or auction_dict['end_time'] > existing_auction_dict['end_time'] \
-                    or auction_dict['price'] > existing_auction_dict['price']
-        except TypeError:
-            # Short-circuiting of previous expressions will fail if evaluates
-            # in place of None
-            pass
+    # Determine which entry is newer.  Where either is missing a value, the
+    # comparison fails and the existing auction is treated as newer.
+    try:
+        current_newer = auction_dict['n_bids'] > existing_auction_dict['n_bids'] \
+                or auction_dict['end_time'] > existing_auction_dict['end_time'] \
+                or auction_dict['price'] > existing_auction_dict['price']
+    except TypeError:
+        # Short-circuiting of previous expressions will fail if evaluates
+        # in place of None
+        pass
 
     if current_newer:
-        a = _merge_dicts(existing_auction_dict, auction_dict)
+        return _merge_dicts(existing_auction_dict, auction_dict)
     else:
-        a = _merge_dicts(auction_dict, existing_auction_dict)
+        return _merge_dicts(auction_dict, existing_auction_dict)
+
+# Returns the ebay_auctions row as a dict with every entry, or one of Nones if
+# there is no row
+def _existing_auction_dict(row):
+    existing_auction_dict = {}
+    for e in ebay_listings_entries:
+        existing_auction_dict[e] = None
+
+    if row is not None:
+        # Merge existing entries
+        for name, e in zip(ebay_listings_entries, row):
+            if e is not None:
+                existing_auction_dict[name] = e
+    return existing_auction_dict
+
+_INSERT_AUCTION = '''INSERT INTO ebay_auctions (
+        auction_id, title, seller, start_time, end_time, n_bids,
+        price, currency_code, starting_price) VALUES (
+        ?, ?, ?, ?, ?, ?, ?, ?, ?
+        )'''
+_INSERT_SELLER = '''INSERT OR IGNORE INTO ebay_profiles (
+        profile_id, contacted, permission_given) VALUES(?, ?, ?)'''
+
+def _auction_values(auction_id, a):
+    return (auction_id, a['title'], a['seller'], a['start_time'], \
+            a['end_time'], a['n_bids'], a['price'], a['currency_code'], \
+            a['starting_price'])
+
+def _merge_and_write_auction(c, auction_id, auction_dict):
+    # Determine if an auction of the given id currently exists
+    c.execute('SELECT * FROM ebay_auctions WHERE auction_id=?',\
+            (auction_id,))
+    r = c.fetchall()
+    existing_entry = r[0] if r else None
+
+    a = _merge_newer(_existing_auction_dict(existing_entry), auction_dict)
 
     # Write out to the database
-    @_db_transaction_factory(db_path)
-    def _(c):
-        # Delete the row
-        if existing_entry is not None:
-            c.execute('DELETE FROM ebay_auctions WHERE auction_id=?', \
-                    (auction_id,))
-
-        # Update the row to its new values
-        c.execute('''INSERT INTO ebay_auctions (
-            auction_id, title, seller, start_time, end_time, n_bids,
-            price, currency_code, starting_price, image_paths) VALUES (
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ""
-            )''',
-            (auction_id, a['title'], a['seller'], a['start_time'], \
-                a['end_time'], a['n_bids'], a['price'], a['currency_code'], \
-                a['starting_price']))
+    # Delete the row
+    if existing_entry is not None:
+        c.execute('DELETE FROM ebay_auctions WHERE auction_id=?', \
+                (auction_id,))
+
+    # Update the row to its new values
+    c.execute(_INSERT_AUCTION, _auction_values(auction_id, a))
 
     # Update the sellers table
-    @_db_transaction_factory(db_path)
-    def _(c):
-        c.execute('''INSERT OR IGNORE INTO ebay_profiles (
-                profile_id, contacted, permission_given) VALUES(?, ?, ?)''', \
-                (a['seller'], 0, 0,))
+    c.execute(_INSERT_SELLER, (a['seller'], 0, 0,))
+
+# Merges the auctions, a dict of auction IDs to normalised auctions, into the
+# database through c as _merge_and_write_auction would one at a time, but
+# reading and writing them all together
+def _write_auctions(c, auctions):
+    auction_ids = list(auctions)
+    existing_entries = {}
+    # Stay within SQLite's default limit of 999 parameters
+    for i in range(0, len(auction_ids), 500):
+        chunk = auction_ids[i:i+500]
+        # Auction IDs are matched as in _merge_and_write_auction, converted by
+        # the column's affinity, but returned as given
+        c.execute('''SELECT given.column1, ebay_auctions.*
+                FROM (VALUES {}) AS given JOIN ebay_auctions
+                ON ebay_auctions.auction_id = given.column1''' \
+                .format(', '.join(['(?)'] * len(chunk))), chunk)
+        for row in c.fetchall():
+            existing_entries[row[0]] = row[1:]
+
+    merged = []
+    for auction_id, auction_dict in auctions.items():
+        try:
+            merged.append((auction_id, _merge_newer(_existing_auction_dict( \
+                    existing_entries.get(auction_id)), auction_dict)))
+        except Exception:
+            print(colored('Error processing auction. Skipping...'))
+            print(colored(traceback.format_exc(), 'red'))
+
+    c.execute('SAVEPOINT auctions')
+    try:
+        c.executemany('DELETE FROM ebay_auctions WHERE auction_id=?', \
+                [(auction_id,) for auction_id, _ in merged \
+                if auction_id in existing_entries])
+        c.executemany(_INSERT_AUCTION, \
+                [_auction_values(auction_id, a) for auction_id, a in merged])
+        c.executemany(_INSERT_SELLER, [(a['seller'], 0, 0) for _, a in merged])
+    except Exception:
+        # Write them one at a time instead, to skip only those that fail
+        c.execute('ROLLBACK TO auctions')
+        for auction_id, auction_dict in auctions.items():
+            _write_auction(c, lambda c: \
+                    _merge_and_write_auction(c, auction_id, auction_dict))
+    c.execute('RELEASE auctions')
 
 
 if __name__ == "__main__":